@@ -11,6 +11,37 @@ STRIPE.setdefault("verify_ssl_certs", getattr(stripe, "verify_ssl_certs", None))
 STRIPE.setdefault("default_http_client", getattr(stripe, "default_http_client", None))
 STRIPE.setdefault("use_connect", False)
 STRIPE.setdefault("project_title", None)
+STRIPE.setdefault("cache", {})
+STRIPE.setdefault("http_client", {})
+STRIPE.setdefault("rate_limit", {})
+STRIPE.setdefault("circuit_breaker", {})
+# "inline" processes webhook events in the request, "queue" only stores them for the
+# rf_stripe_process_events command.
+STRIPE.setdefault("event_processing", "inline")
+# "retrieve" verifies webhook events by retrieving them from stripe, "signature" checks
+# the `Stripe-Signature` header against `webhook_secrets` instead.
+STRIPE.setdefault("webhook_verification", "retrieve")
+STRIPE.setdefault("webhook_secrets", [])
+STRIPE.setdefault("webhook_tolerance", 300)
+STRIPE.setdefault("webhook_verification_fallback", False)
+# retry budgets for stripe requests by call site, see `retry`
+STRIPE.setdefault("retries", {})
+# apply the objects of webhook events to their local copies, see `handlers`
+STRIPE.setdefault("default_handlers", False)
+# the size of the thread pool for webhook handlers registered as independent
+STRIPE.setdefault("webhook_workers", 4)
+# the models that get a GIN index on `source`, see `rf_stripe_source_indexes`
+STRIPE.setdefault("source_indexes", [])
+# the default and maximum number of objects per page of list endpoints
+STRIPE.setdefault("page_size", 100)
+STRIPE.setdefault("max_page_size", 1000)
+# the maximum number of stripe requests in flight for the asyncio api
+STRIPE.setdefault("async_concurrency", 20)
+
+if STRIPE["default_http_client"] is None:
+    from .client import PooledRequestsClient
+    STRIPE["default_http_client"] = PooledRequestsClient(
+        verify_ssl_certs=STRIPE["verify_ssl_certs"], **STRIPE["http_client"])
 
 stripe.api_key = STRIPE["api_key"]
 stripe.api_base = STRIPE["api_base"]
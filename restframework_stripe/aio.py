@@ -0,0 +1,66 @@
+""" asyncio support for the stripe api. the stripe library only makes blocking requests,
+so coroutines in this module run the blocking calls on a shared thread pool and await
+the result, which lets an event loop keep many stripe requests in flight at once. the
+number of requests in flight is bounded by `RESTFRAMEWORK_STRIPE["async_concurrency"]`,
+which is read on every call: the thread pool and semaphores are rebuilt when it changes.
+
+as the requests share the pooled http client, `http_client["pool_maxsize"]` should be
+raised to match the concurrency, otherwise connections beyond the pool size are not
+kept alive.
+"""
+import asyncio
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from . import STRIPE
+
+_executor = None
+_executor_size = None
+_semaphores = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def get_concurrency():
+    return STRIPE["async_concurrency"]
+
+
+def get_executor():
+    global _executor, _executor_size
+    with _lock:
+        concurrency = get_concurrency()
+        if _executor is None or _executor_size != concurrency:
+            if _executor is not None:
+                # calls already submitted still finish on the old pool
+                _executor.shutdown(wait=False)
+            _executor = ThreadPoolExecutor(max_workers=concurrency)
+            _executor_size = concurrency
+        return _executor
+
+
+def get_semaphore(loop):
+    """ a semaphore per event loop, since asyncio primitives are bound to a loop.
+    """
+    with _lock:
+        # a semaphore refers to its loop, which keeps the weak key alive, so the
+        # semaphores of closed loops are dropped explicitly
+        for closed in [l for l in _semaphores if l.is_closed()]:
+            del _semaphores[closed]
+        concurrency = get_concurrency()
+        size, semaphore = _semaphores.get(loop, (None, None))
+        if size != concurrency:
+            semaphore = asyncio.Semaphore(concurrency, loop=loop)
+            _semaphores[loop] = (concurrency, semaphore)
+        return semaphore
+
+
+@asyncio.coroutine
+def run_in_pool(func, *args, **kwargs):
+    """ run a blocking stripe call on the thread pool without blocking the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    with (yield from get_semaphore(loop)):
+        result = yield from loop.run_in_executor(
+            get_executor(), functools.partial(func, *args, **kwargs))
+    return result
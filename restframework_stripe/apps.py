@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class RFStripeConfig(AppConfig):
     name = "restframework_stripe"
     verbose_name = "RESTful Stripe Models"
+
+    def ready(self):
+        from . import STRIPE
+        from .handlers import register_default_handlers
+        from .webhooks import webhooks
+        if STRIPE["default_handlers"]:
+            register_default_handlers()
+        webhooks.build_index()
@@ -0,0 +1,358 @@
+""" a read-through cache for stripe api resources. retrieving a resource from stripe is a
+blocking network request, and the same Customer or Account is often retrieved many
+times a minute (every refresh, update and payment source request retrieves it first).
+the `stripe_cache` object sits in front of those retrieves and keeps a serialized copy of
+each resource for a configurable amount of time.
+
+the cache is configured with the `cache` key of the `RESTFRAMEWORK_STRIPE` setting::
+
+    RESTFRAMEWORK_STRIPE = {
+        "cache": {
+            "backend": "locmem",  # or "django", or a dotted path to a backend class
+            "options": {"max_entries": 1000},
+            "default_ttl": 0,  # seconds, 0 disables caching for a resource
+            "ttl": {"Customer": 30, "Account": 60},
+            "coalesce": True,  # share concurrent identical retrieves within a process
+            "lock_timeout": 0,  # seconds, see below
+            }
+        }
+
+cached entries are dropped when a webhook for the same stripe object is processed and
+whenever this package updates or deletes the object.
+
+concurrent retrieves of the same object (the same resource, id, expand and api key)
+within a process share a single request to stripe. with a shared backend and a
+`lock_timeout` the first process to miss the cache takes a short lock, and other
+processes wait up to `lock_timeout` seconds for it to fill the cache instead of sending
+the same request.
+"""
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+import stripe
+
+from . import STRIPE
+
+
+class LocMemBackend:
+    """ an in-process least recently used mapping with per entry expiration.
+    """
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return None
+            if expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def add(self, key, value, ttl):
+        """ set the key only if it is not set, returns True if it was set.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] >= time.time():
+                return False
+            self._data[key] = (time.time() + ttl, value)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoCacheBackend:
+    """ stores entries in one of the projects configured django caches, which allows
+    entries to be shared between processes (e.g. with memcached or redis).
+    """
+    def __init__(self, alias="default"):
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def add(self, key, value, ttl):
+        return self.cache.add(key, value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+
+BACKENDS = {
+    "locmem": LocMemBackend,
+    "django": DjangoCacheBackend,
+    }
+
+
+class SingleFlight:
+    """ runs a function once for all of the threads that ask for the same key at the
+    same time. the first thread calls the function, the others wait for its result.
+    """
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """ :returns: a (result, shared) tuple, shared is True for the waiting threads
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class StripeObjectCache:
+    """ a read-through cache keyed on the stripe resource name, the stripe id, the
+    expanded attributes and the api key used for the request.
+
+    invalidation is done with a per stripe id *tombstone* holding the time the object was
+    invalidated; any entry fetched before its tombstone is treated as a miss. this lets
+    a single stripe id be invalidated regardless of how many expand / api key variants
+    are cached, which is not possible to do by key with most django cache backends.
+    """
+    KEY_PREFIX = "rf_stripe"
+
+    LOCK_POLL_INTERVAL = 0.05
+
+    def __init__(self, backend=None, default_ttl=0, ttl=None, coalesce=True,
+                 lock_timeout=0):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.ttl = ttl or {}
+        self.coalesce = coalesce
+        self.lock_timeout = lock_timeout
+        self.flights = SingleFlight()
+        self.counters = collections.Counter()
+
+    @classmethod
+    def from_settings(cls, config):
+        """ build a cache from the `RESTFRAMEWORK_STRIPE["cache"]` setting.
+        """
+        backend = config.get("backend")
+        if backend is not None:
+            if isinstance(backend, str):
+                backend = BACKENDS.get(backend) or import_string(backend)
+            backend = backend(**config.get("options", {}))
+        return cls(backend, config.get("default_ttl", 0), config.get("ttl"),
+                   config.get("coalesce", True), config.get("lock_timeout", 0))
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    @property
+    def max_ttl(self):
+        return max([self.default_ttl] + list(self.ttl.values()))
+
+    def get_ttl(self, resource_name):
+        return self.ttl.get(resource_name, self.default_ttl)
+
+    def make_key(self, resource_name, stripe_id, expand=None, api_key=None):
+        api_key = api_key or stripe.api_key or ""
+        key_hash = hashlib.sha1(api_key.encode("utf-8")).hexdigest()[:12]
+        expand = ",".join(sorted(expand or ()))
+        return "{0}:{1}:{2}:{3}:{4}".format(
+            self.KEY_PREFIX, resource_name, stripe_id, expand, key_hash)
+
+    def _tombstone_key(self, stripe_id):
+        return "{0}:invalidated:{1}".format(self.KEY_PREFIX, stripe_id)
+
+    def get(self, resource_name, stripe_id, expand=None, api_key=None):
+        """ return the cached stripe object or None. a new stripe object is constructed
+        for every hit so callers are free to mutate the result.
+        """
+        if not self.enabled:
+            return None
+        stripe_object = self._lookup(resource_name, stripe_id, expand, api_key)
+        self.counters["hits" if stripe_object is not None else "misses"] += 1
+        return stripe_object
+
+    def _lookup(self, resource_name, stripe_id, expand=None, api_key=None):
+        entry = self.backend.get(self.make_key(resource_name, stripe_id, expand, api_key))
+        if entry is not None:
+            invalidated = self.backend.get(self._tombstone_key(stripe_id))
+            if invalidated is None or entry["fetched"] > invalidated:
+                stripe_object = stripe.convert_to_stripe_object(
+                    json.loads(entry["object"]), api_key or stripe.api_key, None)
+                stripe_object._fetched_at = entry["fetched"]
+                return stripe_object
+        return None
+
+    def set(self, resource_name, stripe_object, expand=None, api_key=None, fetched=None):
+        ttl = self.get_ttl(resource_name)
+        if not self.enabled or not ttl:
+            return
+        key = self.make_key(resource_name, stripe_object["id"], expand, api_key)
+        fetched = fetched or time.time()
+        entry = {"fetched": fetched, "object": json.dumps(stripe_object)}
+        self.backend.set(key, entry, ttl)
+
+    def retrieve(self, stripe_resource, stripe_id, expand=None):
+        """ retrieve a stripe resource, reading through the cache. `stripe_resource` is
+        a stripe api class such as `stripe.Customer`.
+        """
+        resource_name = stripe_resource.__name__
+        if self.get_ttl(resource_name):
+            stripe_object = self.get(resource_name, stripe_id, expand)
+            if stripe_object is not None:
+                return stripe_object
+
+        if not self.coalesce:
+            return self._fetch(stripe_resource, stripe_id, expand)
+
+        def fetch():
+            # the result is shared as json before any caller sees it, so no caller can
+            # mutate the object while another one is copying it
+            stripe_object = self._fetch(stripe_resource, stripe_id, expand)
+            return stripe_object._fetched_at, json.dumps(stripe_object)
+
+        key = self.make_key(resource_name, stripe_id, expand)
+        (fetched, payload), shared = self.flights.do(key, fetch)
+        if shared:
+            self.counters["coalesced"] += 1
+        # every caller, the leader included, gets its own copy to mutate
+        stripe_object = stripe.convert_to_stripe_object(
+            json.loads(payload), stripe.api_key, None)
+        stripe_object._fetched_at = fetched
+        return stripe_object
+
+    def _fetch(self, stripe_resource, stripe_id, expand=None):
+        """ retrieve from stripe and fill the cache, taking the cross process lock if one
+        is configured. the returned object's `_fetched_at` is the time it was requested.
+        """
+        resource_name = stripe_resource.__name__
+        if not self.get_ttl(resource_name):
+            fetched = time.time()
+            stripe_object = self._retrieve(stripe_resource, stripe_id, expand)
+            stripe_object._fetched_at = fetched
+            return stripe_object
+
+        lock_key = None
+        if self.lock_timeout:
+            key = self.make_key(resource_name, stripe_id, expand)
+            lock_key = "{0}:lock".format(key)
+            if not self.backend.add(lock_key, 1, self.lock_timeout):
+                stripe_object = self._wait_for(resource_name, stripe_id, expand)
+                if stripe_object is not None:
+                    self.counters["coalesced"] += 1
+                    return stripe_object
+                lock_key = None
+
+        try:
+            # an invalidation that arrives while the request is in flight must win
+            fetched = time.time()
+            stripe_object = self._retrieve(stripe_resource, stripe_id, expand)
+            stripe_object._fetched_at = fetched
+            self.set(resource_name, stripe_object, expand, fetched=fetched)
+        finally:
+            if lock_key is not None:
+                self.backend.delete(lock_key)
+        return stripe_object
+
+    def _wait_for(self, resource_name, stripe_id, expand=None):
+        """ wait for another process to fill the cache, None if it did not in time.
+        """
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(self.LOCK_POLL_INTERVAL)
+            stripe_object = self._lookup(resource_name, stripe_id, expand)
+            if stripe_object is not None:
+                return stripe_object
+        return None
+
+    def _retrieve(self, stripe_resource, stripe_id, expand=None):
+        if expand:
+            return stripe_resource.retrieve(stripe_id, expand=expand)
+        return stripe_resource.retrieve(stripe_id)
+
+    def invalidate(self, *stripe_ids):
+        """ drop every cached variant of the given stripe ids.
+        """
+        if not self.enabled:
+            return
+        for stripe_id in stripe_ids:
+            if not stripe_id:
+                continue
+            self.counters["invalidations"] += 1
+            # the tombstone only needs to outlive the longest lived entry
+            self.backend.set(self._tombstone_key(stripe_id), time.time(),
+                             self.max_ttl or 1)
+
+    def invalidate_object(self, stripe_object):
+        """ invalidate a stripe object along with the customer or account it is attached
+        to, since they may embed it (e.g. an expanded `default_source`).
+        """
+        owners = [stripe_object.get(k) for k in ("customer", "account")]
+        owners = [o for o in owners if isinstance(o, str)]
+        self.invalidate(stripe_object.get("id"), *owners)
+
+    def stats(self):
+        return {
+            "hits": self.counters["hits"],
+            "misses": self.counters["misses"],
+            "invalidations": self.counters["invalidations"],
+            "coalesced": self.counters["coalesced"],
+            }
+
+    def clear(self):
+        self.counters.clear()
+        if self.enabled:
+            self.backend.clear()
+
+
+stripe_cache = StripeObjectCache.from_settings(STRIPE["cache"])
@@ -0,0 +1,116 @@
+""" a circuit breaker for stripe api requests. when stripe is slow or unavailable every
+request would otherwise block until it times out. once too many of the recent requests
+failed or were slow the circuit *opens* and requests fail immediately with a
+`CircuitOpenError`. after `reset_timeout` seconds a single trial request is let through,
+which closes the circuit again if it succeeds.
+
+the breaker is disabled unless the `circuit_breaker` setting is given::
+
+    RESTFRAMEWORK_STRIPE = {
+        "circuit_breaker": {
+            "window": 20,  # the number of recent requests to consider
+            "min_requests": 10,  # do not open before this many requests were seen
+            "failure_rate": 0.5,  # open when this share of the window failed
+            "slow_call_duration": 5,  # seconds, slower requests count as failures
+            "reset_timeout": 30,  # seconds to fail fast before a trial request
+            }
+        }
+
+network errors and 5xx responses count as failures. while the circuit is open, read
+endpoints serve the local copies with a `Warning: 110` (stale) header.
+"""
+import collections
+import threading
+import time
+
+import stripe
+
+from . import STRIPE
+
+
+class CircuitOpenError(stripe.APIConnectionError):
+    """ raised instead of sending a request while the circuit is open.
+    """
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, enabled=True, window=20, min_requests=10, failure_rate=0.5,
+                 slow_call_duration=5, reset_timeout=30):
+        self.enabled = enabled
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.slow_call_duration = slow_call_duration
+        self.reset_timeout = reset_timeout
+        self._outcomes = collections.deque(maxlen=window)
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, config):
+        """ build a circuit breaker from the `RESTFRAMEWORK_STRIPE["circuit_breaker"]`
+        setting.
+        """
+        if not config:
+            return cls(enabled=False)
+        return cls(**config)
+
+    def _current_state(self):
+        if (self._state == self.OPEN and
+                time.monotonic() - self._opened_at >= self.reset_timeout):
+            self._state = self.HALF_OPEN
+            self._trial = False
+        return self._state
+
+    def _open(self):
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    @property
+    def is_open(self):
+        return self.enabled and self.state != self.CLOSED
+
+    def before_request(self):
+        """ :raises: CircuitOpenError if the request may not be sent
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            state = self._current_state()
+            if state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+            if state != self.CLOSED:
+                raise CircuitOpenError("Stripe is unavailable, the request was not sent.")
+
+    def record(self, failed, duration=0):
+        """ record the outcome of a request that was sent.
+        """
+        if not self.enabled:
+            return
+        failed = failed or duration >= self.slow_call_duration
+        with self._lock:
+            if self._current_state() == self.HALF_OPEN:
+                if failed:
+                    self._open()
+                else:
+                    self._state = self.CLOSED
+                return
+            self._outcomes.append(failed)
+            if (len(self._outcomes) >= self.min_requests and
+                    sum(self._outcomes) / len(self._outcomes) >= self.failure_rate):
+                self._open()
+
+
+circuit_breaker = CircuitBreaker.from_settings(STRIPE["circuit_breaker"])
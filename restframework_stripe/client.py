@@ -0,0 +1,97 @@
+""" a pooled, keep-alive http client for the stripe library. the client shipped with
+stripe calls `requests.request` for every api call, which creates a new session and pays
+for a new TCP connection and TLS handshake on every request. `PooledRequestsClient` keeps
+a single `requests.Session` per process so connections to the stripe api are reused.
+
+every request waits for the client side rate limiter (see `ratelimit`) before it is
+sent, and passes through the circuit breaker (see `circuitbreaker`).
+
+the client is installed as `stripe.default_http_client` unless a `default_http_client`
+is configured explicitly, and can be tuned with the `http_client` setting::
+
+    RESTFRAMEWORK_STRIPE = {
+        "http_client": {
+            "pool_connections": 10,  # number of hosts to keep pools for
+            "pool_maxsize": 10,  # connections kept alive per host
+            "pool_block": False,  # wait for a free connection instead of opening more
+            "connect_timeout": 5,
+            "read_timeout": 80,
+            "keep_alive": True,
+            }
+        }
+"""
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import stripe
+from stripe.http_client import RequestsClient
+
+from .circuitbreaker import circuit_breaker
+from .ratelimit import rate_limiter
+
+
+class PooledRequestsClient(RequestsClient):
+    """ a drop in replacement for `stripe.http_client.RequestsClient` that sends every
+    request through one persistent session.
+    """
+    name = "requests"
+
+    def __init__(self, verify_ssl_certs=True, pool_connections=10, pool_maxsize=10,
+                 pool_block=False, connect_timeout=5, read_timeout=80, keep_alive=True,
+                 rate_limiter=rate_limiter, circuit_breaker=circuit_breaker):
+        super().__init__(verify_ssl_certs=verify_ssl_certs)
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize, pool_block=pool_block)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+
+    def get_verify(self):
+        if self._verify_ssl_certs:
+            return os.path.join(os.path.dirname(stripe.http_client.__file__),
+                                "data/ca-certificates.crt")
+        return False
+
+    def request(self, method, url, headers, post_data=None):
+        self.rate_limiter.acquire_for_headers(headers)
+        self.circuit_breaker.before_request()
+        started = time.monotonic()
+        failed = True
+        try:
+            result = self.session.request(method, url, headers=headers, data=post_data,
+                                          timeout=self.timeout, verify=self.get_verify())
+            # read the content here so a socket timeout is handled like any other
+            # connection error
+            content = result.content
+            status_code = result.status_code
+            failed = status_code >= 500
+        except Exception as err:
+            self._handle_request_error(err)
+        finally:
+            self.circuit_breaker.record(failed, time.monotonic() - started)
+        return content, status_code, result.headers
+
+    def post(self, url, **kwargs):
+        """ a plain POST through the pooled session, used for requests outside of the
+        stripe api such as the connect oauth token exchange.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, **kwargs)
+
+
+def post(url, **kwargs):
+    """ POST with the configured stripe http client if it supports plain requests,
+    otherwise fall back to `requests.post`.
+    """
+    http_client = stripe.default_http_client
+    if isinstance(http_client, PooledRequestsClient):
+        return http_client.post(url, **kwargs)
+    return requests.post(url, **kwargs)
@@ -0,0 +1,52 @@
+""" the built-in webhook handlers. a webhook event already holds the current state of its
+object in `data.object`, so the handlers here apply it to the local copy instead of
+retrieving the object from stripe again.
+
+the handlers are registered when the app is ready if the `default_handlers` setting is
+True::
+
+    RESTFRAMEWORK_STRIPE = {
+        "default_handlers": True,
+        }
+"""
+from django.db import transaction
+
+from .webhooks import webhooks
+
+
+# the top level event types whose objects (or the objects of their subtypes, such as
+# `customer.subscription.updated`) have a local model
+DEFAULT_EVENT_TYPES = ("account", "charge", "coupon", "customer", "plan", "transfer")
+
+
+def apply_event_object(event, data, event_subtype):
+    """ update the local copy of the object of an event, if there is one. objects that
+    do not exist locally are left for the application to create. the local copy of an
+    object deleted with stripe (a `*.deleted` event) is deleted, unless other local
+    objects still refer to it.
+    """
+    if not data or event is None:
+        return
+    stripe_object = data.get("object") or {}
+    model = type(event).get_object_models().get(stripe_object.get("object"))
+    if model is None:
+        return
+
+    # a deleted subscription is only canceled, stripe still keeps it
+    if (event_subtype.split(".")[-1] == "deleted" and
+            stripe_object.get("object") != "subscription"):
+        model.objects.filter(stripe_id=stripe_object.get("id")).delete_unreferenced()
+        return
+
+    with transaction.atomic():
+        instance = model.objects.select_for_update().filter(
+            stripe_id=stripe_object.get("id")).first()
+        if instance is not None:
+            # the conversion pops attributes off the object, which is part of the event
+            instance.apply_stripe_object(dict(stripe_object), event.source.get("created"))
+
+
+def register_default_handlers(registry=webhooks):
+    for event_type in DEFAULT_EVENT_TYPES:
+        if apply_event_object not in registry.REGISTRY[event_type]:
+            registry.register(event_type)(apply_event_object)
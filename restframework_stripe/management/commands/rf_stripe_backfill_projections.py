@@ -0,0 +1,28 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from restframework_stripe.models import StripeModel
+
+
+class Command(BaseCommand):
+    """ Fill in the `SOURCE_PROJECTIONS` columns of rows that were stored before the
+    columns were added (or before a projection was declared), e.g. after migrating::
+
+        ./manage.py migrate restframework_stripe
+        ./manage.py rf_stripe_backfill_projections
+
+    The values are extracted from `source` by the database in batches of primary keys,
+    so the command is safe to run on large tables while the application is running.
+    """
+    help = "Fill in the projected columns of StripeModels from their source."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000,
+                            help="number of primary keys updated per statement.")
+
+    def handle(self, *args, **options):
+        for model in apps.get_app_config("restframework_stripe").get_models():
+            if not issubclass(model, StripeModel) or not model.SOURCE_PROJECTIONS:
+                continue
+            updated = model.objects.backfill_projections(options["batch_size"])
+            self.stdout.write("{0}: {1} rows updated.".format(model.__name__, updated))
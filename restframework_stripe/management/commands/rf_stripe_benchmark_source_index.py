@@ -0,0 +1,102 @@
+import json
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+
+TABLE = "rf_stripe_source_benchmark"
+
+QUERIES = (
+    # what `Charge.objects.metadata(order_id=...)` emits
+    ("containment", "SELECT id FROM {table} WHERE source @> %s::jsonb",
+     lambda order_id: [json.dumps({"metadata": {"order_id": str(order_id)}})]),
+    # what filtering on a key transform, e.g. `source__metadata__order_id=...`, emits
+    ("key lookup", "SELECT id FROM {table} WHERE source -> 'metadata' ->> 'order_id' = %s",
+     lambda order_id: [str(order_id)]),
+    )
+
+
+class Command(BaseCommand):
+    """ Measure how much a GIN index on `source` (see `rf_stripe_source_indexes`) speeds
+    up the containment queries of `source_contains` and `metadata`.
+
+    A temporary table with `--rows` charge-like sources is generated, each query is
+    timed `--repeat` times for random metadata values without and with the index, and
+    the median times are reported. The temporary table is dropped when the command
+    exits, the tables of the application are not touched. Note that filling a table
+    with a million rows takes a while.
+    """
+    help = "Benchmark containment queries on source with and without a GIN index."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000000,
+                            help="number of rows in the benchmark table.")
+        parser.add_argument("--repeat", type=int, default=20,
+                            help="number of times each query is timed.")
+
+    def handle(self, *args, **options):
+        rows, repeat = options["rows"], options["repeat"]
+        with connection.cursor() as cursor:
+            self.stdout.write("Generating {0} rows...".format(rows))
+            self.create_table(cursor, rows)
+
+            results = {}
+            for label, sql, params in QUERIES:
+                results[label] = self.measure(cursor, sql, params, rows, repeat)
+
+            started = time.perf_counter()
+            cursor.execute(
+                "CREATE INDEX {0}_source_gin ON {0} USING gin (source jsonb_path_ops)"
+                .format(TABLE))
+            cursor.execute("ANALYZE {0}".format(TABLE))
+            self.stdout.write("Created the index in {0:.1f}s, {1}.".format(
+                time.perf_counter() - started, self.index_size(cursor)))
+
+            for label, sql, params in QUERIES:
+                indexed = self.measure(cursor, sql, params, rows, repeat)
+                self.stdout.write(
+                    "{0}: {1:.2f}ms without the index, {2:.2f}ms with it ({3:.0f}x)."
+                    .format(label, results[label], indexed, results[label] / indexed))
+            cursor.execute("DROP TABLE {0}".format(TABLE))
+
+    def create_table(self, cursor, rows):
+        cursor.execute("CREATE TEMPORARY TABLE {0} (id serial PRIMARY KEY, "
+                       "source jsonb NOT NULL)".format(TABLE))
+        cursor.execute("""
+            INSERT INTO {0} (source)
+            SELECT jsonb_build_object(
+                'id', 'ch_' || i,
+                'object', 'charge',
+                'amount', i % 10000,
+                'currency', 'usd',
+                'created', 1400000000 + i,
+                'paid', true,
+                'status', CASE WHEN i % 20 = 0 THEN 'failed' ELSE 'succeeded' END,
+                'customer', 'cus_' || (i % 50000),
+                'outcome', jsonb_build_object('type', 'authorized',
+                                              'network_status', 'approved_by_network'),
+                'metadata', jsonb_build_object('order_id', i::text))
+            FROM generate_series(1, %s) AS i
+            """.format(TABLE), [rows])
+        cursor.execute("ANALYZE {0}".format(TABLE))
+
+    def measure(self, cursor, sql, params, rows, repeat):
+        """ :returns: the median time of the query in milliseconds
+        """
+        sql = sql.format(table=TABLE)
+        timings = []
+        for _ in range(repeat):
+            values = params(random.randint(1, rows))
+            started = time.perf_counter()
+            cursor.execute(sql, values)
+            cursor.fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
+
+    def index_size(self, cursor):
+        cursor.execute("SELECT pg_size_pretty(pg_relation_size(%s))",
+                       ["{0}_source_gin".format(TABLE)])
+        return cursor.fetchone()[0]
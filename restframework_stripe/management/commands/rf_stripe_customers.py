@@ -1,9 +1,15 @@
 import asyncio
+import time
 
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
+from django.db import DatabaseError, transaction
+
+import stripe
 
 from restframework_stripe import STRIPE
+from restframework_stripe.models import Customer
+from restframework_stripe.util import chunked
 
 
 class Command(BaseCommand):
@@ -13,58 +19,100 @@ class Command(BaseCommand):
     The primary usecase for this command is, when adding rf_stripe to an existing Django
     project. Otherwise Customer objects should be created at the time a user registers.
 
+    Users are streamed from the database in chunks. The Stripe customers for a chunk are
+    created concurrently, bounded by the `async_concurrency` setting, and the Customer
+    rows are written with a single bulk insert per chunk. If the bulk insert fails (e.g.
+    a user got a Customer in the meantime) the rows of the chunk are inserted one by
+    one, so the other rows of the chunk are still saved.
+
+    The command can be interrupted and run again: only users without a Customer are
+    processed, and every Stripe customer is created with an idempotency key derived from
+    the users primary key, so a customer that was created with Stripe but not saved
+    locally is returned by Stripe again instead of being duplicated (Stripe keeps
+    idempotency keys for 24 hours).
+
     Futher changes, such as adding subscriptions to Customers can be done at a later
     time.
     """
     help = "Create customer objects for all users without one."
 
-    def handle(self, *args, **kwargs):
-        User = get_user_model()
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500,
+                            help="number of users to create customers for at a time.")
 
-        builders = []
-        for user in User.objects.filter(stripe_customer__isnull=True).iterator():
-            desc = "{0} Customer for {1}.".format(STRIPE["project_title"], user.username)
-            email = user.email
-            builders.append(syncronize_user(user, description=desc, email=email))
-
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(asyncio.gather(*builders, return_exceptions=True))
+    def handle(self, *args, **options):
+        User = get_user_model()
+        users = User.objects.filter(stripe_customer__isnull=True).order_by("pk")
+        total = users.count()
+        created = failed = 0
+        started = time.time()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for chunk in chunked(users.iterator(), options["chunk_size"]):
+            builders = [self.create_stripe_instance(user) for user in chunk]
+            stripe_objects = loop.run_until_complete(asyncio.gather(*builders))
+
+            customers = []
+            for user, stripe_object in zip(chunk, stripe_objects):
+                if stripe_object is None:
+                    failed += 1
+                    continue
+                customer = Customer.stripe_object_to_model(stripe_object)
+                customer.owner = user
+                customers.append(customer)
+            inserted = self.insert_customers(customers)
+            created += inserted
+            failed += len(customers) - inserted
+
+            self.report_progress(created + failed, total, started)
         loop.close()
 
+        self.stdout.write("Created {0} customers, {1} failed.".format(created, failed))
+
+    def insert_customers(self, customers):
+        """ :returns: the number of inserted customers
+        """
+        try:
+            with transaction.atomic():
+                Customer.objects.bulk_create(customers)
+            return len(customers)
+        except DatabaseError:
+            pass
+
+        inserted = 0
+        for customer in customers:
+            try:
+                with transaction.atomic():
+                    customer.save()
+                inserted += 1
+            except DatabaseError as err:
+                self.stderr.write("Error saving {0} for user {1}: {2}".format(
+                    customer.stripe_id, customer.owner_id, err))
+        return inserted
+
+    def report_progress(self, done, total, started):
+        elapsed = time.time() - started
+        rate = done / elapsed if elapsed else 0
+        eta = (total - done) / rate if rate else 0
+        self.stdout.write("{0}/{1} users, {2:.1f} users/s, eta {3:.0f}s".format(
+            done, total, rate, eta))
+
+    @asyncio.coroutine
+    def create_stripe_instance(self, user):
+        """ do the actual Stripe API POST request.
+        """
+        username = user.get_username()
+        desc = "{0} Customer for {1}.".format(STRIPE["project_title"], username)
+        try:
+            stripe_object = yield from Customer.astripe_api_create(
+                description=desc,
+                email=getattr(user, "email", None) or None,
+                metadata={"user_id": user.pk},
+                idempotency_key="rf-stripe-customer-{0}".format(user.pk),
+                )
+        except stripe.StripeError as err:
+            self.stderr.write("Error creating {0}: {1}".format(desc, err._message))
+            return None
+        return stripe_object
 
-@asyncio.coroutine
-def syncronize_user(user, **kwargs):
-    """ the main coroutine for cooperatively sending a request to the Stripe api and,
-    if that succeeds, saving the results to the database.
-    """
-    stripe_object = yield from create_stripe_instance(**kwargs)
-    customer = None
-    if stripe_object is not None:
-        customer = yield from create_stripe_model(user, stripe_object)
-    return customer
-
-
-@asyncio.coroutine
-def create_stripe_instance(**kwargs):
-    """ do the actual Stripe API POST request.
-    """
-    stripe_object = None
-    try:
-        stripe_object = Customer.stripe_api_create(
-            description=desc,
-            )
-    except stripe.StripeError as err:
-        print("Error creating", desc, err._message)
-
-    return stripe_object
-
-
-@asyncio.coroutine
-def create_stripe_model(owner, stripe_object):
-    """ Save the model to the database.
-    """
-    customer_model = Customer.stripe_object_to_model(stripe_object)
-    customer_model.owner = user
-    customer.save()
-    print("Created Customer object for {}".format(owner.username))
-    return customer
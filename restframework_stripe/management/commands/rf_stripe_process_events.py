@@ -0,0 +1,57 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from restframework_stripe.models import Event
+
+
+class Command(BaseCommand):
+    """ Process webhook events that were stored by the webhook endpoint when
+    `RESTFRAMEWORK_STRIPE["event_processing"]` is set to "queue".
+
+    Each worker thread claims one unprocessed event at a time with
+    `SELECT ... FOR UPDATE SKIP LOCKED`, verifies it and calls the registered webhook
+    handlers. Since claiming is done by the database, several instances of this command
+    can be run side by side (e.g. one per host) to scale out with processes as well.
+
+    Failures are recorded as EventProcessingErrors and the event is retried until it has
+    been attempted `--max-attempts` times.
+    """
+    help = "Verify and dispatch queued stripe webhook events."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=4,
+                            help="number of worker threads.")
+        parser.add_argument("--max-attempts", type=int, default=5,
+                            help="stop retrying an event after this many attempts.")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="seconds to sleep when the queue is empty.")
+        parser.add_argument("--once", action="store_true", default=False,
+                            help="exit once the queue is empty instead of polling.")
+
+    def handle(self, *args, **options):
+        concurrency = options["concurrency"]
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            workers = [pool.submit(self.work, options) for _ in range(concurrency)]
+            processed = sum(w.result() for w in workers)
+        self.stdout.write("Processed {} events.".format(processed))
+
+    def work(self, options):
+        """ a single worker loop, returns the number of events it claimed.
+        """
+        processed = 0
+        try:
+            while True:
+                event = Event.objects.process_next(max_attempts=options["max_attempts"])
+                if event is not None:
+                    processed += 1
+                elif options["once"]:
+                    break
+                else:
+                    time.sleep(options["poll_interval"])
+        finally:
+            # each thread has its own database connection
+            connection.close()
+        return processed
@@ -0,0 +1,47 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from restframework_stripe import STRIPE
+from restframework_stripe.models import StripeModel
+
+
+class Command(BaseCommand):
+    """ Create the GIN indexes on `source` of the models listed in the `source_indexes`
+    setting (or given with `--models`), e.g.::
+
+        RESTFRAMEWORK_STRIPE = {
+          "source_indexes": ["Charge", "Subscription"],
+          }
+
+        ./manage.py rf_stripe_source_indexes
+
+    The indexes are used by `source_contains` and `metadata` queries. They are created
+    concurrently, so the tables stay writable, and existing indexes are left alone.
+    With `--drop` the indexes of the given models are dropped instead.
+    """
+    help = "Create (or drop) the GIN indexes on the source of StripeModels."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--models", nargs="+", default=None,
+                            help="the models to index, defaults to the `source_indexes` "
+                                 "setting.")
+        parser.add_argument("--drop", action="store_true", default=False,
+                            help="drop the indexes instead of creating them.")
+
+    def handle(self, *args, **options):
+        names = options["models"] or STRIPE["source_indexes"]
+        models = {model.__name__: model
+                  for model in apps.get_app_config("restframework_stripe").get_models()
+                  if issubclass(model, StripeModel)}
+        unknown = [name for name in names if name not in models]
+        if unknown:
+            raise CommandError("Unknown models: {0}.".format(", ".join(unknown)))
+
+        for name in names:
+            manager = models[name].objects
+            if options["drop"]:
+                manager.drop_source_index()
+                self.stdout.write("{0}: dropped {1}.".format(name, manager.source_index_name))
+            else:
+                manager.create_source_index()
+                self.stdout.write("{0}: created {1}.".format(name, manager.source_index_name))
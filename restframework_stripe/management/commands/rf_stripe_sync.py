@@ -0,0 +1,139 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+import stripe
+
+from restframework_stripe import models
+
+
+# resources are synced in stages, the resources of a stage run in parallel and may
+# depend on the resources of the previous stages (a refund needs its charge and a
+# subscription needs its plan).
+STAGES = (
+    ("Plan", "Coupon", "Charge", "Transfer"),
+    ("Refund", "Subscription"),
+    )
+
+RESOURCES = collections.OrderedDict([
+    ("Plan", models.Plan),
+    ("Coupon", models.Coupon),
+    ("Charge", models.Charge),
+    ("Transfer", models.Transfer),
+    ("Refund", models.Refund),
+    ("Subscription", models.Subscription),
+    ])
+
+
+class Command(BaseCommand):
+    """ Bring the local Charges, Transfers, Refunds, Subscriptions, Plans and Coupons in
+    line with stripe.
+
+    Every resource is listed from stripe one page at a time and written with batched
+    upserts (see `StripeModelManager.upsert_from_stripe`). Resource types are synced in
+    parallel worker threads.
+
+    After a resource has been synced completely the `created` timestamp of the newest
+    object is stored as a SyncCheckpoint, and the next run only lists objects created
+    at or after it (`created[gte]`). Objects that changed after the checkpoint, such as
+    a refunded charge, are only picked up by webhooks or a `--full` run. Subscriptions
+    can not be filtered by stripe and are always listed completely.
+
+    For each resource the number of listed, created, updated (local rows that had
+    drifted from stripe), unchanged and skipped (e.g. charges without a local owner)
+    objects is reported.
+
+    With `--events` the resources are not listed at all. Instead the stripe events
+    created since the last `--events` run are listed and the newest state of each object
+    they contain is applied locally, objects deleted with stripe are deleted locally
+    (see `EventManager.sync_from_stripe`). This is much
+    cheaper than listing every resource and also recovers the changes of webhooks that
+    were missed, e.g. while the webhook endpoint was down. Stripe keeps events for 30
+    days.
+    """
+    help = "Mirror stripe charges, transfers, refunds, subscriptions, plans and coupons."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--resources", nargs="+", default=list(RESOURCES),
+                            choices=list(RESOURCES),
+                            help="the resources to sync, defaults to all of them.")
+        parser.add_argument("--workers", type=int, default=4,
+                            help="number of resources synced at the same time.")
+        parser.add_argument("--batch-size", type=int, default=500,
+                            help="number of objects written per statement.")
+        parser.add_argument("--page-size", type=int, default=100,
+                            help="number of objects requested per page.")
+        parser.add_argument("--full", action="store_true", default=False,
+                            help="ignore the stored checkpoints and list everything.")
+        parser.add_argument("--events", action="store_true", default=False,
+                            help="apply the objects of new stripe events instead of "
+                                 "listing the resources.")
+
+    def handle(self, *args, **options):
+        if options["events"]:
+            return self.sync_events(options)
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+            for stage in STAGES:
+                resources = [r for r in stage if r in options["resources"]]
+                jobs = [(r, pool.submit(self.sync, r, options)) for r in resources]
+                for resource, job in jobs:
+                    try:
+                        self.report(resource, *job.result())
+                    except stripe.StripeError as err:
+                        failed.append(resource)
+                        self.stderr.write("{0}: {1}".format(resource, err._message))
+        if failed:
+            raise CommandError("Failed to sync {0}.".format(", ".join(failed)))
+
+    def sync(self, resource, options):
+        """ sync a single resource, returns the number of listed objects and the
+        UpsertResult.
+        """
+        model = RESOURCES[resource]
+        try:
+            checkpoint, _ = models.SyncCheckpoint.objects.get_or_create(resource=resource)
+            cursor = None if options["full"] else checkpoint.cursor
+            seen = {"listed": 0, "cursor": checkpoint.cursor}
+
+            def stream():
+                stripe_objects = model.list_stripe_api_instances(
+                    created_gte=cursor, page_size=options["page_size"])
+                for stripe_object in stripe_objects:
+                    seen["listed"] += 1
+                    created = stripe_object.get("created")
+                    if created is not None and created > (seen["cursor"] or 0):
+                        seen["cursor"] = created
+                    yield stripe_object
+
+            result = model.objects.upsert_from_stripe(stream(), options["batch_size"])
+            # only advance the checkpoint once everything up to it has been written
+            checkpoint.cursor = seen["cursor"]
+            checkpoint.save()
+        finally:
+            # each thread has its own database connection
+            connection.close()
+        return seen["listed"], result
+
+    def sync_events(self, options):
+        checkpoint, _ = models.SyncCheckpoint.objects.get_or_create(resource="Event")
+        cursor = None if options["full"] else checkpoint.cursor
+        try:
+            result = models.Event.objects.sync_from_stripe(
+                created_gte=cursor, page_size=options["page_size"])
+        except stripe.StripeError as err:
+            raise CommandError(err._message)
+        checkpoint.cursor = result.cursor
+        checkpoint.save()
+        self.stdout.write(
+            "{0.events} events, {0.updated} updated, {0.created} created, "
+            "{0.deleted} deleted, {0.refreshed} refreshed, {0.skipped} skipped."
+            .format(result))
+
+    def report(self, resource, listed, result):
+        self.stdout.write(
+            "{0}: {1} listed, {2.created} created, {2.updated} updated, "
+            "{2.unchanged} unchanged, {2.skipped} skipped.".format(resource, listed, result))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from restframework_stripe.models import Event
+
+
+class Command(BaseCommand):
+    """ Verify a backlog of unverified webhook events by paging through the stripe
+    events list, instead of retrieving every event individually.
+
+    Stripe only lists events from the last 30 days, so by default the window starts 30
+    days ago. Events that are not found are left unverified.
+    """
+    help = "Verify unverified stripe events in bulk."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", type=int, default=None,
+                            help="unix timestamp, defaults to 30 days ago.")
+        parser.add_argument("--until", type=int, default=None,
+                            help="unix timestamp, defaults to now.")
+        parser.add_argument("--page-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        since = options["since"]
+        if since is None:
+            since = int(time.time()) - 30 * 24 * 60 * 60
+
+        verified, missing = Event.objects.verify_bulk(
+            created_gte=since, created_lte=options["until"],
+            page_size=options["page_size"])
+
+        self.stdout.write("Verified {} events.".format(verified))
+        if missing:
+            self.stdout.write("{} unverified events were not found with stripe.".format(
+                missing))
@@ -1,15 +1,317 @@
-import requests
+import collections
+import copy
 
+from django.contrib.contenttypes.fields import GenericForeignKey
 from django.core.exceptions import ValidationError as DJValidationError
+from django.db import connections, models, transaction
 from django.db.models import manager
 from django.utils import timezone
 
 import stripe
 
-from .util import recursive_mapping_update
+from . import client
+from .util import chunked, list_all, recursive_mapping_update
 
 
-class ConnectedAccountManager(manager.Manager):
+UpsertResult = collections.namedtuple(
+    "UpsertResult", ["created", "updated", "unchanged", "skipped"])
+EventSyncResult = collections.namedtuple(
+    "EventSyncResult",
+    ["events", "updated", "created", "deleted", "refreshed", "skipped", "cursor"])
+
+
+class StripeModelQuerySet(models.QuerySet):
+    """ The queryset of all StripeModels.
+    """
+    def source_contains(self, value=None, **attributes):
+        """ filter by the stripe object in `source`, using the jsonb containment
+        operator `@>` so the query can use a GIN index on `source` (see
+        `StripeModelManager.create_source_index`)::
+
+            Charge.objects.source_contains(status="succeeded", outcome__type="authorized")
+            Subscription.objects.source_contains(items__data=[{"plan": {"id": "gold"}}])
+
+        a list matches when it contains the given items, in any order.
+
+        :param value: a dict (or list) that must be contained in `source`
+        :param attributes: attributes that must be contained in `source`, `__` separates
+            the keys of nested objects
+        """
+        contained = {} if value is None else copy.deepcopy(value)
+        for path, attribute in attributes.items():
+            keys = path.split("__")
+            for key in reversed(keys[1:]):
+                attribute = {key: attribute}
+            contained = recursive_mapping_update(contained, **{keys[0]: attribute})
+        return self.filter(source__contains=contained)
+
+    def metadata(self, **metadata):
+        """ filter by the metadata of the stripe object, e.g.
+        `Charge.objects.metadata(order_id=42)`. stripe stores metadata values as
+        strings, so the values are converted.
+        """
+        return self.source_contains(
+            metadata={key: str(value) for key, value in metadata.items()})
+
+    def delete_unreferenced(self):
+        """ delete the local copies of objects that were deleted with stripe, except
+        those that other local objects still refer to: stripe keeps a deleted plan or
+        coupon on the subscriptions that use it, while deleting the row would delete
+        the subscriptions with it.
+
+        :returns: the number of deleted objects
+        """
+        queryset = self
+        for relation in self.model._meta.related_objects:
+            if relation.one_to_many or relation.one_to_one:
+                queryset = queryset.filter(**{relation.name + "__isnull": True})
+        _, deleted = queryset.delete()
+        return deleted.get(self.model._meta.label, 0)
+
+
+class StripeModelManager(manager.Manager.from_queryset(StripeModelQuerySet)):
+    """ The default manager of all StripeModels.
+    """
+    def in_bulk_by_stripe_id(self, stripe_ids):
+        """ :returns: a mapping of stripe id to model instance
+        """
+        return {obj.stripe_id: obj for obj in self.filter(stripe_id__in=set(stripe_ids))}
+
+    def upsert_from_stripe(self, stripe_objects, batch_size=500):
+        """ convert a stream of stripe objects and write them to the database with
+        `INSERT ... ON CONFLICT (stripe_id) DO UPDATE`, one statement per batch. only
+        the columns produced by `stripe_object_to_record` are updated for existing rows,
+        so local fields such as `owner` are left alone. rows whose `source` already
+        matches the stripe object are not written at all.
+
+        new rows need an owner (for models that have one) which is resolved from the
+        customer or account the object belongs to, and any other required relation
+        (e.g. the plan of a subscription); objects with a relation that can not be
+        resolved and that do not exist locally are skipped.
+
+        requires PostgreSQL 9.5 or higher.
+
+        :param stripe_objects: an iterable of stripe objects
+        :returns: an UpsertResult of the created, updated, unchanged and skipped counts.
+            `updated` counts the local rows that had drifted from stripe.
+        """
+        created = updated = unchanged = skipped = 0
+        for batch in chunked(stripe_objects, batch_size):
+            records = self.model.stripe_objects_to_records(batch)
+            instances = [self.model(**record) for record in records]
+            instances, missing = self._resolve_relations(instances)
+            skipped += missing
+
+            # rows are grouped by the keys of their record so an attribute missing from
+            # one record (e.g. an unexpanded default source) is not overwritten with null.
+            # a statement can not update the same row twice, so the last object wins.
+            groups = collections.OrderedDict()
+            for record, instance in zip(records, instances):
+                if instance is not None:
+                    group = groups.setdefault(tuple(sorted(record)), {})
+                    group[instance.stripe_id] = instance
+            for keys, group in groups.items():
+                c, u = self._upsert(list(group.values()), self.get_update_fields(keys))
+                created += c
+                updated += u
+                unchanged += len(group) - c - u
+        return UpsertResult(created, updated, unchanged, skipped)
+
+    def _resolve_relations(self, instances):
+        """ fill in the required relations of the instances, first from stripe (see
+        `StripeModel.resolve_owners`) and then from the existing rows.
+
+        :returns: the instances, with None in place of those that can not be saved,
+            and the number of instances that were dropped
+        """
+        required = [f.attname for f in self.model._meta.concrete_fields
+                    if f.is_relation and not f.null]
+        if not required:
+            return instances, 0
+        if "owner_id" in required:
+            self.model.resolve_owners(instances)
+
+        def is_complete(instance):
+            return all(getattr(instance, attname) is not None for attname in required)
+
+        unresolved = [i for i in instances if not is_complete(i)]
+        if unresolved:
+            existing = self.filter(stripe_id__in=[i.stripe_id for i in unresolved])
+            existing = {row[0]: row[1:] for row in
+                        existing.values_list("stripe_id", *required)}
+            for instance in unresolved:
+                values = existing.get(instance.stripe_id, [None] * len(required))
+                for attname, value in zip(required, values):
+                    if getattr(instance, attname) is None:
+                        setattr(instance, attname, value)
+
+        instances = [i if is_complete(i) else None for i in instances]
+        return instances, instances.count(None)
+
+    def get_update_fields(self, keys):
+        """ the attribute names to save for the keys of a record.
+        """
+        attnames = []
+        for key in keys:
+            field = self.model._meta.get_field(key)
+            if isinstance(field, GenericForeignKey):
+                attnames.append(self.model._meta.get_field(field.ct_field).attname)
+                attnames.append(field.fk_field)
+            else:
+                attnames.append(field.attname)
+        return attnames
+
+    def _upsert(self, instances, update_fields):
+        meta = self.model._meta
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        fields = [f for f in meta.concrete_fields if not f.primary_key]
+
+        rows, params = [], []
+        for instance in instances:
+            rows.append("({0})".format(", ".join(["%s"] * len(fields))))
+            params.extend(f.get_db_prep_save(getattr(instance, f.attname), connection)
+                          for f in fields)
+
+        updates = ["{0} = EXCLUDED.{0}".format(quote(f.column)) for f in fields
+                   if f.attname in update_fields and f.name != "stripe_id"]
+        sql = (
+            "INSERT INTO {table} ({columns}) VALUES {rows} "
+            "ON CONFLICT ({stripe_id}) DO UPDATE SET {updates} "
+            "WHERE {table}.{source} IS DISTINCT FROM EXCLUDED.{source} "
+            # xmax is only 0 for rows that were inserted by this statement
+            "RETURNING (xmax = 0)"
+            ).format(
+                table=quote(meta.db_table),
+                columns=", ".join(quote(f.column) for f in fields),
+                rows=", ".join(rows),
+                stripe_id=quote(meta.get_field("stripe_id").column),
+                source=quote(meta.get_field("source").column),
+                updates=", ".join(updates),
+                )
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            inserted = [row[0] for row in cursor.fetchall()]
+        created = sum(1 for i in inserted if i)
+        return created, len(inserted) - created
+
+    def _bulk_update(self, instances, update_fields):
+        """ save the given fields of many instances with a single
+        `UPDATE ... FROM (VALUES ...)` statement.
+
+        :returns: the number of updated rows
+        """
+        if not instances:
+            return 0
+        meta = self.model._meta
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        fields = [meta.pk] + [f for f in meta.concrete_fields
+                              if f.attname in update_fields and not f.primary_key]
+
+        rows, params = [], []
+        for instance in instances:
+            # the values are cast to their column types, jsonb is not assigned from text
+            rows.append("({0})".format(", ".join(
+                ["%s"] + ["%s::{0}".format(f.db_type(connection)) for f in fields[1:]])))
+            params.extend(f.get_db_prep_save(getattr(instance, f.attname), connection)
+                          for f in fields)
+
+        sql = (
+            "UPDATE {table} SET {updates} FROM (VALUES {rows}) AS v ({columns}) "
+            "WHERE {table}.{pk} = v.{pk}"
+            ).format(
+                table=quote(meta.db_table),
+                updates=", ".join("{0} = v.{0}".format(quote(f.column)) for f in fields[1:]),
+                rows=", ".join(rows),
+                columns=", ".join(quote(f.column) for f in fields),
+                pk=quote(meta.pk.column),
+                )
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def backfill_projections(self, batch_size=10000):
+        """ set the `SOURCE_PROJECTIONS` columns of existing rows from their `source`.
+        the values are extracted by the database, with one UPDATE statement per
+        `batch_size` range of primary keys to keep the row locks short.
+
+        :returns: the number of rows updated
+        """
+        projections = self.model.SOURCE_PROJECTIONS
+        if not projections:
+            return 0
+        meta = self.model._meta
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        source = quote(meta.get_field("source").column)
+
+        updates = []
+        for name, path in sorted(projections.items()):
+            field = meta.get_field(name)
+            keys = path.split(".")
+            # an expanded object is projected to its id
+            value = "COALESCE({0} #>> '{{{1}}}', {0} #>> '{{{2}}}')".format(
+                source, ",".join(keys + ["id"]), ",".join(keys))
+            if field.get_internal_type() == "DateTimeField":
+                value = "to_timestamp(({0})::bigint)".format(value)
+            else:
+                value = "CAST({0} AS {1})".format(value, field.db_type(connection))
+            updates.append("{0} = {1}".format(quote(field.column), value))
+
+        sql = "UPDATE {table} SET {updates} WHERE {pk} >= %s AND {pk} < %s".format(
+            table=quote(meta.db_table), updates=", ".join(updates),
+            pk=quote(meta.pk.column))
+
+        bounds = self.aggregate(first=models.Min("pk"), last=models.Max("pk"))
+        if bounds["first"] is None:
+            return 0
+        updated = 0
+        with connection.cursor() as cursor:
+            for start in range(bounds["first"], bounds["last"] + 1, batch_size):
+                cursor.execute(sql, [start, start + batch_size])
+                updated += cursor.rowcount
+        return updated
+
+    @property
+    def source_index_name(self):
+        return "{0}_source_gin".format(self.model._meta.db_table)
+
+    def create_source_index(self, concurrently=True):
+        """ create a GIN index with the `jsonb_path_ops` operator class on `source`,
+        which speeds up the containment queries of `source_contains` and `metadata`.
+        the index is opt-in since it has to be kept up to date on every write, see the
+        `rf_stripe_source_indexes` management command.
+
+        `CREATE INDEX CONCURRENTLY` does not lock the table against writes but can not
+        run inside a transaction.
+        """
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        meta = self.model._meta
+        sql = "CREATE INDEX {concurrently}IF NOT EXISTS {name} ON {table} " \
+              "USING gin ({source} jsonb_path_ops)".format(
+                  concurrently="CONCURRENTLY " if concurrently else "",
+                  name=quote(self.source_index_name),
+                  table=quote(meta.db_table),
+                  source=quote(meta.get_field("source").column))
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+
+    def drop_source_index(self, concurrently=True):
+        """ drop the index created by `create_source_index`, if it exists.
+        """
+        connection = connections[self.db]
+        sql = "DROP INDEX {concurrently}IF EXISTS {name}".format(
+            concurrently="CONCURRENTLY " if concurrently else "",
+            name=connection.ops.quote_name(self.source_index_name))
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+
+
+class ConnectedAccountManager(StripeModelManager):
     """ This manager provides additional methods for creating managed and
     connecting standalone stripe accounts.
     """
@@ -41,7 +343,7 @@ class ConnectedAccountManager(manager.Manager):
             "code": auth_code,
             }
         uri = "https://connect.stripe.com/oauth/token"
-        response = requests.post(uri, params=data).json()
+        response = client.post(uri, params=data).json()
         if response.get("error"):
             # 100% likely to be an error on our end from the `auth_code` parameter
             raise stripe.InvalidRequestError(
@@ -65,7 +367,7 @@ class ConnectedAccountManager(manager.Manager):
         return connected_account
 
 
-class PlanManager(manager.Manager):
+class PlanManager(StripeModelManager):
     """
     """
     def create_resource_from_model(self, model):
@@ -85,6 +387,8 @@ class PlanManager(manager.Manager):
             stripe_object = self.model.stripe_api_create(**kwargs)
             model.stripe_id = stripe_object["id"]
             model.source = stripe_object
+            for key, value in self.model.project_source(stripe_object).items():
+                setattr(model, key, value)
             model.is_created = True
         except stripe.InvalidRequestError as err:
             raise DJValidationError(message={err.param: err._message})
@@ -92,7 +396,7 @@ class PlanManager(manager.Manager):
         return model
 
 
-class CouponManager(manager.Manager):
+class CouponManager(StripeModelManager):
     """
     """
     def create_resource_from_model(self, model):
@@ -114,6 +418,8 @@ class CouponManager(manager.Manager):
             stripe_object = self.model.stripe_api_create(**kwargs)
             model.stripe_id = stripe_object["id"]
             model.source = stripe_object
+            for key, value in self.model.project_source(stripe_object).items():
+                setattr(model, key, value)
             model.is_created = True
         except stripe.InvalidRequestError as err:
             raise DJValidationError(message={err.param: err._message})
@@ -121,7 +427,7 @@ class CouponManager(manager.Manager):
         return model
 
 
-class RefundManager(manager.Manager):
+class RefundManager(StripeModelManager):
     def create_resource_from_model(self, model):
         kwargs = {
             "charge": model.charge.stripe_id,
@@ -135,9 +441,214 @@ class RefundManager(manager.Manager):
             stripe_object = self.model.stripe_api_create(**kwargs)
             model.stripe_id = stripe_object["id"]
             model.source = stripe_object
+            for key, value in self.model.project_source(stripe_object).items():
+                setattr(model, key, value)
             model.owner = model.charge.owner
             model.is_created = True
         except stripe.InvalidRequestError as err:
             raise DJValidationError(message={err.param: err._message})
 
         return model
+
+
+class EventManager(StripeModelManager):
+    """ This manager provides methods for receiving webhook events and claiming them for
+    processing from a queue of unprocessed events.
+    """
+    def receive(self, payload, verified=False):
+        """ store an incoming webhook payload as an Event. stripe may deliver the same
+        event more than once, in which case the existing Event is returned.
+
+        :param payload: the json body of a webhook request
+        :type payload: dict
+        :param verified: True if the payload was already verified by its signature
+        :type verified: bool
+        :returns: restframework_stripe.models.Event
+        """
+        record = self.model.stripe_object_to_record(dict(payload))
+        record["verified"] = verified
+        stripe_id = record.pop("stripe_id")
+        event, created = self.get_or_create(stripe_id=stripe_id, defaults=record)
+        if not created and verified and not event.verified:
+            event.verified = True
+            event.save(update_fields=["verified"])
+        return event
+
+    def verify_bulk(self, created_gte=None, created_lte=None, page_size=100):
+        """ verify unverified events by listing events from stripe rather than retrieving
+        them one at a time. each page of listed events is matched against the local
+        unverified events by `stripe_id`, so a backlog of N events costs N / `page_size`
+        requests and two queries. like `Event.verify`, the payload received by the
+        webhook is replaced with the listed event, so a forged payload with a real event
+        id is never used.
+
+        :param created_gte: unix timestamp, only list events created at or after it
+        :param created_lte: unix timestamp, only list events created at or before it
+        :returns: a tuple of the number of events verified and the number of local
+            unverified events that were not found with stripe
+        """
+        unverified = self.filter(verified=False)
+        remaining = unverified.count()
+        verified = 0
+
+        created = {}
+        if created_gte is not None:
+            created["gte"] = created_gte
+        if created_lte is not None:
+            created["lte"] = created_lte
+        params = {"limit": page_size}
+        if created:
+            params["created"] = created
+
+        while remaining:
+            page = stripe.Event.list(**params)
+            listed = collections.OrderedDict((e["id"], e) for e in page)
+            if not listed:
+                break
+            with transaction.atomic():
+                events = list(unverified.filter(stripe_id__in=list(listed)))
+                for event in events:
+                    event.stripe_object_sync(listed[event.stripe_id])
+                    event.verified = True
+                self._bulk_update(events, ["source", "event_type", "verified"])
+            verified += len(events)
+            remaining -= len(events)
+            if not page.get("has_more"):
+                break
+            params["starting_after"] = next(reversed(listed))
+
+        return verified, remaining
+
+    def sync_from_stripe(self, created_gte=None, page_size=100):
+        """ bring the local mirrors up to date from the events feed instead of listing
+        every resource. events are listed newest first and only the newest state of each
+        object is applied: objects that exist locally are updated with
+        `apply_stripe_object`, new objects are created with `upsert_from_stripe`. the
+        local copy of an object deleted with stripe (a `*.deleted` event) is deleted,
+        unless other local objects still refer to it (see `delete_unreferenced`).
+
+        events whose object has no local model (e.g. an invoice or a dispute) can still
+        change a mirrored resource, so the first charge, subscription or customer they
+        refer to is retrieved from stripe instead, if it exists locally.
+
+        :param created_gte: unix timestamp, only list events created at or after it,
+            usually the `cursor` of the previous run
+        :returns: an EventSyncResult, `cursor` is the creation time of the newest event
+        """
+        object_models = self.model.get_object_models()
+        related_models = self.model.get_related_object_models()
+        counts = collections.Counter()
+        cursor = created_gte
+        seen = set()
+
+        params = {}
+        if created_gte is not None:
+            params["created"] = {"gte": created_gte}
+        events = list_all(stripe.Event, page_size, **params)
+        for page in chunked(events, page_size):
+            changed = collections.defaultdict(collections.OrderedDict)
+            deleted = collections.defaultdict(set)
+            referenced = collections.defaultdict(set)
+            for event in page:
+                counts["events"] += 1
+                cursor = max(cursor or 0, event["created"])
+                stripe_object = event["data"]["object"]
+                stripe_id = stripe_object.get("id")
+                if stripe_id in seen:
+                    # a newer event for the object was already applied
+                    continue
+                seen.add(stripe_id)
+
+                model = object_models.get(stripe_object.get("object"))
+                # a deleted subscription is only canceled, stripe still keeps it
+                if (model is not None and event["type"].endswith(".deleted") and
+                        stripe_object.get("object") != "subscription"):
+                    deleted[model].add(stripe_id)
+                    continue
+                if model is not None:
+                    changed[model][stripe_id] = (stripe_object, event["created"])
+                    continue
+                for key, related_model in related_models.items():
+                    related = stripe_object.get(key)
+                    if isinstance(related, dict):
+                        related = related.get("id")
+                    if isinstance(related, str):
+                        if related not in seen:
+                            seen.add(related)
+                            referenced[related_model].add(related)
+                        break
+
+            for model, stripe_objects in changed.items():
+                for stripe_id, instance in model.objects.in_bulk_by_stripe_id(
+                        stripe_objects).items():
+                    # an event of the same second was most likely applied by its
+                    # webhook already
+                    if instance.apply_stripe_object(*stripe_objects.pop(stripe_id),
+                                                    retrieve_ties=False):
+                        counts["updated"] += 1
+                result = model.objects.upsert_from_stripe(
+                    stripe_object for stripe_object, _ in stripe_objects.values())
+                counts["created"] += result.created
+                counts["skipped"] += result.skipped
+
+            for model, stripe_ids in deleted.items():
+                counts["deleted"] += model.objects.filter(
+                    stripe_id__in=stripe_ids).delete_unreferenced()
+
+            for model, stripe_ids in referenced.items():
+                for instance in model.objects.filter(stripe_id__in=stripe_ids):
+                    try:
+                        instance.refresh_from_stripe_api()
+                    except stripe.InvalidRequestError:
+                        # e.g. the resource was deleted since the event was sent
+                        counts["skipped"] += 1
+                        continue
+                    instance.save()
+                    counts["refreshed"] += 1
+
+        return EventSyncResult(counts["events"], counts["updated"], counts["created"],
+                               counts["deleted"], counts["refreshed"], counts["skipped"],
+                               cursor)
+
+    def unprocessed(self, max_attempts=None):
+        """ events waiting to be processed, oldest first.
+        """
+        qs = self.filter(processed=False).order_by("id")
+        if max_attempts is not None:
+            qs = qs.filter(attempts__lt=max_attempts)
+        return qs
+
+    def _claim(self, queryset):
+        """ lock and return the first object of the queryset that is not locked by
+        another transaction. `select_for_update(skip_locked=True)` was added in django
+        1.11, on older versions the clause is appended to the query.
+        """
+        features = connections[self.db].features
+        if getattr(features, "has_select_for_update_skip_locked", False):
+            return queryset.select_for_update(skip_locked=True).first()
+        sql, params = queryset[:1].query.sql_with_params()
+        claimed = list(self.raw(sql + " FOR UPDATE SKIP LOCKED", params))
+        return claimed[0] if claimed else None
+
+    def process_next(self, max_attempts=None):
+        """ claim the oldest unprocessed event with `SELECT ... FOR UPDATE SKIP LOCKED`
+        and process it. the row stays locked until processing is finished, so any number
+        of concurrent workers (threads or processes) can safely drain the queue.
+
+        :returns: the processed event or None if the queue is empty
+        """
+        with transaction.atomic():
+            event = self._claim(self.unprocessed(max_attempts))
+            if event is None:
+                return None
+
+            event.attempts += 1
+            event.save(update_fields=["attempts"])
+            try:
+                with transaction.atomic():
+                    event.process()
+            except Exception as err:
+                # stripe errors are recorded by `Event.process` itself, anything else
+                # raised by a handler must not take the worker down.
+                event.processing_errors.create(message=repr(err))
+            return event
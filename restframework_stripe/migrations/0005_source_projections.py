@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restframework_stripe', '0004_last_event_created'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='charge',
+            name='amount',
+            field=models.PositiveIntegerField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='charge',
+            name='created',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='charge',
+            name='currency',
+            field=models.CharField(blank=True, db_index=True, max_length=3, null=True),
+        ),
+        migrations.AddField(
+            model_name='charge',
+            name='customer_stripe_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='charge',
+            name='paid',
+            field=models.NullBooleanField(),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='created',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='currency',
+            field=models.CharField(blank=True, db_index=True, max_length=3, null=True),
+        ),
+        migrations.AddField(
+            model_name='transfer',
+            name='amount',
+            field=models.PositiveIntegerField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transfer',
+            name='created',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transfer',
+            name='currency',
+            field=models.CharField(blank=True, db_index=True, max_length=3, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restframework_stripe', '0005_source_projections'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='charge',
+            index_together=set([('owner', 'created', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='refund',
+            index_together=set([('owner', 'created', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='transfer',
+            index_together=set([('owner', 'created', 'id')]),
+        ),
+    ]
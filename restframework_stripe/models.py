@@ -1,14 +1,26 @@
+import asyncio
+import collections
+import datetime
+import re
+import time
+
+from django.apps import apps
 from django.db import models
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import ValidationError as DJValidationError
+from django.utils import timezone
 
 import stripe
 
+from . import aio
 from . import managers
-from .webhooks import webhooks
+from .cache import stripe_cache
+from .retry import create_with_retries, make_idempotency_key
+from .util import list_all
+from .webhooks import handler_name, webhooks
 
 
 class StripeModel(models.Model):
@@ -26,11 +38,27 @@ class StripeModel(models.Model):
     creating, and updating a resource -- doing so gives a client an accurate account of
     the resource without requiring a round trip to stripe. this attribute should also be
     updated on any corresponding webhooks.
+
+    ``last_event_created`` the creation time (a unix timestamp) of the newest webhook
+    event that was applied to ``source``, or the time ``source`` was last requested
+    from the api if that is newer. older events are not applied. stripe's event times
+    are compared with the local clock, so the clocks are assumed to be in sync.
+
+    ``SOURCE_PROJECTIONS`` a mapping of field name to a dotted path into ``source``.
+    the fields are set from the source whenever a stripe object is converted, so
+    attributes that are filtered or sorted on can be stored in real, indexed columns.
+    an expanded object is projected to its id, and a unix timestamp to a datetime for
+    a DateTimeField. existing rows are filled in with the
+    `rf_stripe_backfill_projections` management command.
     """
     STRIPE_API_NAME = None
+    SOURCE_PROJECTIONS = {}
 
     stripe_id = models.CharField(max_length=100, unique=True)
     source = JSONField()
+    last_event_created = models.PositiveIntegerField(null=True, editable=False)
+
+    objects = managers.StripeModelManager()
 
     class Meta:
         abstract = True
@@ -50,12 +78,27 @@ class StripeModel(models.Model):
 
     @classmethod
     def get_stripe_api_instance(cls, stripe_id):
-        stripe_resource = cls.get_stripe_api()
-        return stripe_resource.retrieve(stripe_id)
+        return stripe_cache.retrieve(cls.get_stripe_api(), stripe_id)
 
     @classmethod
-    def stripe_api_create(cls, **kwargs):
-        return cls.get_stripe_api().create(**kwargs)
+    def stripe_api_create(cls, idempotency_key=None, **kwargs):
+        """ create the stripe resource, retrying failed requests with the same
+        idempotency key (see `restframework_stripe.retry`).
+        """
+        call_site = "{0}.create".format(cls.STRIPE_API_NAME)
+        return create_with_retries(call_site, cls.get_stripe_api().create,
+                                   idempotency_key, **kwargs)
+
+    @classmethod
+    def list_stripe_api_instances(cls, created_gte=None, page_size=100):
+        """ iterate over every stripe object of this resource, newest first.
+
+        :param created_gte: unix timestamp, only list objects created at or after it
+        """
+        params = {}
+        if created_gte is not None:
+            params["created"] = {"gte": created_gte}
+        return list_all(cls.get_stripe_api(), page_size, **params)
 
     @classmethod
     def stripe_object_to_record(cls, stripe_object):
@@ -63,24 +106,154 @@ class StripeModel(models.Model):
             "stripe_id": stripe_object.pop("id"),
             "source": stripe_object
             }
+        record.update(cls.project_source(stripe_object))
         return record
 
+    @classmethod
+    def project_source(cls, source):
+        """ :returns: the values of the `SOURCE_PROJECTIONS` fields for a source
+        """
+        values = {}
+        for name, path in cls.SOURCE_PROJECTIONS.items():
+            value = source
+            for key in path.split("."):
+                value = value.get(key) if isinstance(value, dict) else None
+            if isinstance(value, dict):
+                value = value.get("id")
+            field = cls._meta.get_field(name)
+            if isinstance(field, models.DateTimeField) and isinstance(value, int):
+                value = datetime.datetime.fromtimestamp(value, tz=timezone.utc)
+            values[name] = value
+        return values
+
     @classmethod
     def stripe_object_to_model(cls, stripe_object):
         return cls(**cls.stripe_object_to_record(stripe_object))
 
-    def stripe_object_sync(self, stripe_object):
+    @classmethod
+    def stripe_objects_to_records(cls, stripe_objects):
+        """ convert many stripe objects to records. subclasses that look up related
+        models override this to resolve the relations for all of the objects at once.
+        """
+        return [cls.stripe_object_to_record(stripe_object) for stripe_object in stripe_objects]
+
+    @classmethod
+    def stripe_objects_to_models(cls, stripe_objects):
+        """ convert many stripe objects to unsaved model instances, e.g. for
+        `bulk_create`.
+        """
+        return [cls(**record) for record in cls.stripe_objects_to_records(stripe_objects)]
+
+    @classmethod
+    def resolve_owners(cls, instances):
+        """ set the owner of unsaved instances from the stripe Customer or Account their
+        source belongs to, with one query per owner type.
+        """
+        by_customer = collections.defaultdict(list)
+        by_account = collections.defaultdict(list)
+        for instance in instances:
+            if getattr(instance, "owner_id", True) is not None:
+                continue
+            for key, lookup in (("customer", by_customer), ("destination", by_account),
+                                ("account", by_account)):
+                owner = instance.source.get(key)
+                if isinstance(owner, dict):
+                    owner = owner.get("id")
+                if isinstance(owner, str):
+                    lookup[owner].append(instance)
+                    break
+
+        for owner_model, lookup in ((Customer, by_customer), (ConnectedAccount, by_account)):
+            if not lookup:
+                continue
+            owners = owner_model.objects.filter(stripe_id__in=list(lookup))
+            for stripe_id, owner_id in owners.values_list("stripe_id", "owner_id"):
+                for instance in lookup[stripe_id]:
+                    instance.owner_id = owner_id
+
+    def stripe_object_sync(self, stripe_object, fetched=None):
+        """ :param fetched: the time (a unix timestamp) the object was requested from
+            stripe, defaults to its `_fetched_at` attribute. webhook events created
+            before it are older than the object and are not applied afterwards.
+        """
         record = self.stripe_object_to_record(stripe_object)
         for key, value in record.items():
             setattr(self, key, value)
+        if fetched is None:
+            fetched = getattr(stripe_object, "_fetched_at", None)
+        if fetched is not None:
+            self.last_event_created = max(self.last_event_created or 0, int(fetched))
         return self
 
+    def apply_stripe_object(self, stripe_object, event_created=None, retrieve_ties=True):
+        """ sync with the object of a webhook event and save only the synced fields, so
+        that no api request is needed to update the local copy.
+
+        event times have a resolution of one second, so the order of an event created
+        in the same second as the last applied one is unknown. the current state of the
+        object is retrieved from stripe instead in that case.
+
+        :param event_created: the creation time of the event, the object is not applied
+            if a newer event was applied already
+        :param retrieve_ties: False to skip an event of the same second instead of
+            retrieving the object, e.g. when the event may have been applied already
+        :returns: False if the object was not applied, otherwise True
+        """
+        if event_created is not None and self.last_event_created is not None:
+            if event_created < self.last_event_created:
+                return False
+            if event_created == self.last_event_created:
+                if not retrieve_ties:
+                    return False
+                requested = time.time()
+                stripe_object = self.retrieve_stripe_api_instance()
+                event_created = max(event_created, int(
+                    getattr(stripe_object, "_fetched_at", requested)))
+
+        # the bulk conversion leaves out relations that do not exist locally instead of
+        # raising, e.g. the plan of a subscription that was created elsewhere
+        record = self.stripe_objects_to_records([stripe_object])[0]
+        for key, value in record.items():
+            setattr(self, key, value)
+        update_fields = type(self).objects.get_update_fields(record)
+        if event_created is not None:
+            self.last_event_created = event_created
+            update_fields.append("last_event_created")
+        self.save(update_fields=update_fields)
+        return True
+
     def retrieve_stripe_api_instance(self):
         return self.get_stripe_api_instance(self.stripe_id)
 
     def refresh_from_stripe_api(self):
+        # a cached object keeps the time it was originally requested
+        requested = time.time()
         stripe_object = self.retrieve_stripe_api_instance()
-        self.stripe_object_sync(stripe_object)
+        self.stripe_object_sync(stripe_object, getattr(stripe_object, "_fetched_at",
+                                                       requested))
+
+    # asyncio counterparts of the methods above, see `restframework_stripe.aio`.
+
+    @classmethod
+    @asyncio.coroutine
+    def aget_stripe_api_instance(cls, stripe_id):
+        return (yield from aio.run_in_pool(cls.get_stripe_api_instance, stripe_id))
+
+    @classmethod
+    @asyncio.coroutine
+    def astripe_api_create(cls, **kwargs):
+        return (yield from aio.run_in_pool(cls.stripe_api_create, **kwargs))
+
+    @asyncio.coroutine
+    def aretrieve_stripe_api_instance(self):
+        return (yield from aio.run_in_pool(self.retrieve_stripe_api_instance))
+
+    @asyncio.coroutine
+    def arefresh_from_stripe_api(self):
+        requested = time.time()
+        stripe_object = yield from self.aretrieve_stripe_api_instance()
+        self.stripe_object_sync(stripe_object, getattr(stripe_object, "_fetched_at",
+                                                       requested))
 
 
 class DefaultPaymentMixin(models.Model):
@@ -94,23 +267,35 @@ class DefaultPaymentMixin(models.Model):
 
     def retrieve_stripe_api_instance(self):
         """ The process for updating payment / payout methods for stripe objects is
-        a bit different than other api objects. The steps involved are as follows.
+        a bit different than other api objects, as they are nested under the Account or
+        Customer that owns them. The steps involved are as follows.
         1) Determine if this object is owned by an Account or a Customer
-        2) Retrieve the Account or Customer instace
-        3) Retrieve the payment method instance using the `sources` or `external_account`
-            parameter
-        4) Perform Updates
-        5) Call the `.save` method
+        2) Address the payment method instance directly with the owners id stored in
+            `source`, e.g. /v1/customers/<customer>/sources/<id>
+        3) Perform Updates
+        4) Call the `.save` method
+
+        If the owners id was not stored locally the Account or Customer is retrieved
+        first and the payment method is retrieved through its `sources` or
+        `external_accounts` list.
         """
-        owner = self.owner
-        if self.source.get("account"):
+        owner_field = "account" if self.source.get("account") else "customer"
+        owner_id = self.source.get(owner_field)
+        if owner_id is None:
+            return self._retrieve_through_owner(owner_field)
+
+        instance = self.get_stripe_api().construct_from(
+            {"id": self.stripe_id, owner_field: owner_id}, stripe.api_key)
+        return instance.refresh()
+
+    def _retrieve_through_owner(self, owner_field):
+        if owner_field == "account":
             owner_param, source_param = "stripe_account", "external_accounts"
         else:
             owner_param, source_param = "stripe_customer", "sources"
-        stripe_owner = getattr(owner, owner_param)
+        stripe_owner = getattr(self.owner, owner_param)
         stripe_owner = stripe_owner.retrieve_stripe_api_instance()
-        instance = stripe_owner[source_param].retrieve(self.stripe_id)
-        return instance
+        return stripe_owner[source_param].retrieve(self.stripe_id)
 
     def save(self, *args, **kwargs):
         if self.default_for_currency is True and self.currency:
@@ -154,7 +339,10 @@ class Customer(StripeModel):
 
     def add_payment_source(self, token):
         stripe_object = self.retrieve_stripe_api_instance()
-        new_source = stripe_object.sources.create(source=token)
+        # a token can only be used once, so it identifies the operation
+        new_source = create_with_retries(
+            "add_payment_source", stripe_object.sources.create,
+            make_idempotency_key("source", token), source=token)
 
         class_name = new_source.class_name()
         if class_name == "bankaccount":
@@ -169,23 +357,61 @@ class Customer(StripeModel):
         return source
 
     @classmethod
-    def stripe_object_to_record(cls, stripe_object):
-        record = super().stripe_object_to_record(stripe_object)
+    def get_default_source_models(cls):
+        return {"bankaccount": BankAccount, "card": Card}
+
+    @classmethod
+    def get_default_source_reference(cls, stripe_object):
+        """ :returns: a (class name, stripe id) tuple for an expanded default source
+        """
         default_source = stripe_object.get("default_source", None)
         if default_source is not None and isinstance(default_source, stripe.StripeObject):
             class_name = default_source.class_name()
-            if class_name == "bankaccount":
-                default_source = BankAccount.objects.get(stripe_id=default_source["id"])
-                record["default_source"] = default_source
-            elif class_name == "card":  # pragma: no branch
-                default_source = Card.objects.get(stripe_id=default_source["id"])
-                record["default_source"] = default_source
+            if class_name in cls.get_default_source_models():  # pragma: no branch
+                return class_name, default_source["id"]
+        return None
+
+    @classmethod
+    def stripe_object_to_record(cls, stripe_object, default_sources=None):
+        """ :param default_sources: an optional mapping of (class name, stripe id) to
+            already loaded sources, see `stripe_objects_to_models`
+        """
+        record = super().stripe_object_to_record(stripe_object)
+        reference = cls.get_default_source_reference(stripe_object)
+        if reference is not None:
+            if default_sources is not None:
+                record["default_source"] = default_sources.get(reference)
+            else:
+                class_name, stripe_id = reference
+                source_model = cls.get_default_source_models()[class_name]
+                record["default_source"] = source_model.objects.get(stripe_id=stripe_id)
         return record
 
+    @classmethod
+    def stripe_objects_to_records(cls, stripe_objects):
+        """ convert many stripe customers to records, resolving their default sources
+        with one query per source type instead of one query per customer.
+        """
+        stripe_objects = list(stripe_objects)
+        references = collections.defaultdict(set)
+        for stripe_object in stripe_objects:
+            reference = cls.get_default_source_reference(stripe_object)
+            if reference is not None:
+                references[reference[0]].add(reference[1])
+
+        default_sources = {}
+        for class_name, stripe_ids in references.items():
+            source_model = cls.get_default_source_models()[class_name]
+            for source in source_model.objects.filter(stripe_id__in=stripe_ids):
+                default_sources[(class_name, source.stripe_id)] = source
+
+        return [cls.stripe_object_to_record(stripe_object, default_sources)
+                for stripe_object in stripe_objects]
+
     @classmethod
     def get_stripe_api_instance(cls, stripe_id):
-        stripe_resource = cls.get_stripe_api()
-        return stripe_resource.retrieve(stripe_id, expand=["default_source"])
+        return stripe_cache.retrieve(cls.get_stripe_api(), stripe_id,
+                                     expand=["default_source"])
 
 
 class Card(DefaultPaymentMixin, StripeModel):
@@ -274,10 +500,28 @@ class Charge(StripeModel):
     .. _Stripe Charge:: https://stripe.com/docs/api/python#charge_object
     """
     STRIPE_API_NAME = "Charge"
+    SOURCE_PROJECTIONS = {
+        "amount": "amount",
+        "currency": "currency",
+        "created": "created",
+        "paid": "paid",
+        "customer_stripe_id": "customer",
+        }
 
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="stripe_charges")
     status = models.CharField(max_length=25)
 
+    amount = models.PositiveIntegerField(null=True, db_index=True)
+    currency = models.CharField(max_length=3, null=True, blank=True, db_index=True)
+    created = models.DateTimeField(null=True, db_index=True)
+    paid = models.NullBooleanField()
+    customer_stripe_id = models.CharField(max_length=100, null=True, blank=True,
+                                          db_index=True)
+
+    class Meta:
+        # the keyset of owner-scoped list endpoints, see `pagination.KeysetPagination`
+        index_together = [("owner", "created", "id")]
+
     @classmethod
     def stripe_object_to_record(cls, stripe_object):
         record = super().stripe_object_to_record(stripe_object)
@@ -370,7 +614,9 @@ class ConnectedAccount(StripeModel):
 
     def add_payment_source(self, token):
         stripe_object = self.retrieve_stripe_api_instance()
-        new_source = stripe_object.external_accounts.create(external_account=token)
+        new_source = create_with_retries(
+            "add_payment_source", stripe_object.external_accounts.create,
+            make_idempotency_key("external-account", token), external_account=token)
 
         class_name = new_source.class_name()
         if class_name == "bankaccount":
@@ -448,10 +694,23 @@ class Transfer(StripeModel):
     .. _Stripe Transfer:: https://stripe.com/docs/api/python#transfer_object
     """
     STRIPE_API_NAME = "Transfer"
+    SOURCE_PROJECTIONS = {
+        "amount": "amount",
+        "currency": "currency",
+        "created": "created",
+        }
 
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="stripe_transfers")
     status = models.CharField(max_length=20)
 
+    amount = models.PositiveIntegerField(null=True, db_index=True)
+    currency = models.CharField(max_length=3, null=True, blank=True, db_index=True)
+    created = models.DateTimeField(null=True, db_index=True)
+
+    class Meta:
+        # the keyset of owner-scoped list endpoints, see `pagination.KeysetPagination`
+        index_together = [("owner", "created", "id")]
+
     @classmethod
     def stripe_object_to_record(cls, stripe_object):
         record = super().stripe_object_to_record(stripe_object)
@@ -481,14 +740,56 @@ class Subscription(StripeModel):
     canceled = models.BooleanField(default=False)
 
     @classmethod
-    def stripe_object_to_record(cls, stripe_object):
+    def stripe_object_to_record(cls, stripe_object, plans=None, coupons=None):
+        """ :param plans: an optional mapping of stripe id to already loaded Plans, see
+            `stripe_objects_to_records`
+        :param coupons: an optional mapping of stripe id to already loaded Coupons
+        """
         record = super().stripe_object_to_record(stripe_object)
-        record["plan"] = Plan.objects.get(stripe_id=stripe_object["plan"]["id"])
+        plan = stripe_object["plan"]["id"]
+        if plans is None:
+            record["plan"] = Plan.objects.get(stripe_id=plan)
+        elif plan in plans:
+            record["plan"] = plans[plan]
         if stripe_object.get("discount", None) is not None:
             coupon = stripe_object["discount"]["coupon"]["id"]
-            record["coupon"] = Coupon.objects.get(stripe_id=coupon)
+            if coupons is None:
+                record["coupon"] = Coupon.objects.get(stripe_id=coupon)
+            elif coupon in coupons:
+                record["coupon"] = coupons[coupon]
+        record["canceled"] = stripe_object.get("status") == "canceled"
         return record
 
+    @classmethod
+    def stripe_objects_to_records(cls, stripe_objects):
+        """ convert many stripe subscriptions to records, resolving their plans and
+        coupons with one query each. plans and coupons that do not exist locally are
+        left out of the records.
+        """
+        stripe_objects = list(stripe_objects)
+        plans = {s["plan"]["id"] for s in stripe_objects}
+        coupons = {s["discount"]["coupon"]["id"] for s in stripe_objects
+                   if s.get("discount", None) is not None}
+        plans = Plan.objects.in_bulk_by_stripe_id(plans)
+        coupons = Coupon.objects.in_bulk_by_stripe_id(coupons)
+        return [cls.stripe_object_to_record(stripe_object, plans, coupons)
+                for stripe_object in stripe_objects]
+
+    @classmethod
+    def list_stripe_api_instances(cls, created_gte=None, page_size=100):
+        """ subscriptions can only be listed through the customers they belong to, so
+        every subscription is listed regardless of `created_gte`.
+        """
+        for customer in list_all(stripe.Customer, page_size):
+            page = customer.get("subscriptions")
+            while page is not None:
+                data = page.get("data", [])
+                for subscription in data:
+                    yield subscription
+                if not data or not page.get("has_more"):
+                    break
+                page = page.all(limit=page_size, starting_after=data[-1]["id"])
+
     def retrieve_stripe_api_instance(self):
         customer = self.owner.stripe_customer
         customer = customer.retrieve_stripe_api_instance()
@@ -506,6 +807,13 @@ class Event(StripeModel):
     # since a webhook is an open uri we need to verify the existance of the Event with
     # stripe before doing anything with it.
     verified = models.BooleanField(default=False)
+    # the number of times a worker has claimed this event from the queue
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # the names of the independent handlers that failed, the only ones that are called
+    # when the event is processed again
+    failed_handlers = JSONField(default=list, editable=False)
+
+    objects = managers.EventManager()
 
     @classmethod
     def stripe_object_to_record(cls, stripe_object):
@@ -513,21 +821,60 @@ class Event(StripeModel):
         record["event_type"] = stripe_object["type"]
         return record
 
+    @classmethod
+    def get_object_models(cls):
+        """ the models that mirror the objects of an event, by the stripe object name
+        derived from their `STRIPE_API_NAME` (e.g. *bank_account* for BankAccount).
+        """
+        object_models = {}
+        for model in apps.get_app_config(cls._meta.app_label).get_models():
+            if issubclass(model, StripeModel) and model is not cls:
+                name = re.sub(r"(?<!^)(?=[A-Z])", "_", model.STRIPE_API_NAME).lower()
+                object_models[name] = model
+        return object_models
+
+    @classmethod
+    def get_related_object_models(cls):
+        """ the models of the resources that an unmirrored object (e.g. an invoice or a
+        dispute) may refer to, by attribute name.
+        """
+        return collections.OrderedDict([
+            ("charge", Charge),
+            ("subscription", Subscription),
+            ("customer", Customer),
+            ])
+
     def process(self):
         """ process the stripe event by distributing this object and its source to all
-        *registered* webhook handlers.
+        *registered* webhook handlers. if independent handlers failed, the event stays
+        unprocessed and processing it again only calls the failed handlers, the ordered
+        handlers already succeeded.
         """
         if self.processed:  # pragma: no cover
             return
 
-        verified = self.verify()
+        # events received with a valid signature do not need to be retrieved
+        verified = self.verified or self.verify()
         if not verified:  # pragma: no cover
             return
 
+        # the payload is newer than anything we may have cached for its object
+        stripe_cache.invalidate_object(self.source["data"].get("object", {}))
+
         event_type, event_subtype = self.event_type.split(".", 1)
         try:
-            webhooks.call_handlers(self, self.source["data"], event_type, event_subtype)
-            self.processed = True
+            failures = webhooks.call_handlers(self, self.source["data"], event_type,
+                                              event_subtype,
+                                              retry=self.failed_handlers or None)
+            for handler, err in failures:
+                EventProcessingError.objects.create(
+                    event=self,
+                    message="{0}: {1}".format(
+                        getattr(handler, "__name__", repr(handler)),
+                        getattr(err, "_message", None) or repr(err)),
+                    )
+            self.failed_handlers = [handler_name(handler) for handler, _ in failures]
+            self.processed = not failures
             self.save()
         except stripe.StripeError as err:
             EventProcessingError.objects.create(
@@ -622,6 +969,22 @@ class Plan(StripeModel):
 
     objects = managers.PlanManager()
 
+    @classmethod
+    def stripe_object_to_record(cls, stripe_object):
+        record = super().stripe_object_to_record(stripe_object)
+        intervals = {label: value for value, label in cls.INTERVAL_CHOICES}
+        record["name"] = record["stripe_id"]
+        record["amount"] = stripe_object["amount"]
+        record["interval"] = intervals[stripe_object["interval"]]
+        # stripe allows longer plan names than the column holds
+        max_length = cls._meta.get_field("name_on_invoice").max_length
+        record["name_on_invoice"] = stripe_object["name"][:max_length]
+        record["statement_descriptor"] = stripe_object.get("statement_descriptor") or ""
+        record["interval_count"] = stripe_object.get("interval_count", 1)
+        record["trial_period_days"] = stripe_object.get("trial_period_days")
+        record["is_created"] = True
+        return record
+
     def save(self, *args, **kwargs):
         """
         :raises: django.core.exceptions.ValidationError
@@ -633,6 +996,7 @@ class Plan(StripeModel):
     def delete(self, *args, **kwargs):
         stripe_object = self.retrieve_stripe_api_instance()
         stripe_object.delete()
+        stripe_cache.invalidate(self.stripe_id)
         return super().delete(*args, **kwargs)
 
 
@@ -662,6 +1026,21 @@ class Coupon(StripeModel):
 
     objects = managers.CouponManager()
 
+    @classmethod
+    def stripe_object_to_record(cls, stripe_object):
+        record = super().stripe_object_to_record(stripe_object)
+        durations = {label: value for value, label in cls.DURATION_CHOICES}
+        record["duration"] = durations[stripe_object["duration"]]
+        for key in ("amount_off", "currency", "duration_in_months", "max_redemptions",
+                    "percent_off"):
+            record[key] = stripe_object.get(key)
+        redeem_by = stripe_object.get("redeem_by")
+        if redeem_by is not None:
+            redeem_by = datetime.datetime.fromtimestamp(redeem_by, tz=timezone.utc)
+        record["redeem_by"] = redeem_by
+        record["is_created"] = True
+        return record
+
     def clean(self, *args, **kwargs):
         if not any([self.amount_off, self.percent_off]):
             raise DJValidationError(message="One of `amount_off`, `percent_off` must be set.")
@@ -686,6 +1065,7 @@ class Coupon(StripeModel):
     def delete(self, *args, **kwargs):
         stripe_object = self.retrieve_stripe_api_instance()
         stripe_object.delete()
+        stripe_cache.invalidate(self.stripe_id)
         return super().delete(*args, **kwargs)
 
 
@@ -703,10 +1083,17 @@ class Refund(StripeModel):
         (REQUESTED, "requested_by_customer")
         )
 
+    SOURCE_PROJECTIONS = {
+        "currency": "currency",
+        "created": "created",
+        }
+
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="stripe_refunds")
 
     charge = models.ForeignKey("Charge", related_name="refunds")
     amount = models.PositiveIntegerField()
+    currency = models.CharField(max_length=3, null=True, blank=True, db_index=True)
+    created = models.DateTimeField(null=True, db_index=True)
     reason = models.PositiveSmallIntegerField(choices=REFUND_REASON_CHOICES)
     refund_application_fee = models.NullBooleanField()
     reverse_transfer = models.NullBooleanField()
@@ -715,6 +1102,51 @@ class Refund(StripeModel):
 
     objects = managers.RefundManager()
 
+    class Meta:
+        # the keyset of owner-scoped list endpoints, see `pagination.KeysetPagination`
+        index_together = [("owner", "created", "id")]
+
+    @classmethod
+    def stripe_object_to_record(cls, stripe_object, charges=None):
+        """ :param charges: an optional mapping of stripe id to already loaded Charges,
+            see `stripe_objects_to_records`
+        """
+        record = super().stripe_object_to_record(stripe_object)
+        reasons = {label: value for value, label in cls.REFUND_REASON_CHOICES}
+        record["amount"] = stripe_object["amount"]
+        # refunds created without a reason are recorded as requested by the customer
+        record["reason"] = reasons.get(stripe_object.get("reason"), cls.REQUESTED)
+        record["is_created"] = True
+
+        charge = stripe_object["charge"]
+        if isinstance(charge, dict):
+            charge = charge["id"]
+        if charges is None:
+            charges = Charge.objects.in_bulk_by_stripe_id([charge])
+        if charge in charges:
+            record["charge"] = charges[charge]
+        return record
+
+    @classmethod
+    def stripe_objects_to_records(cls, stripe_objects):
+        """ convert many stripe refunds to records, resolving their charges with a single
+        query. charges that do not exist locally are left out of the records.
+        """
+        stripe_objects = list(stripe_objects)
+        charges = [s["charge"]["id"] if isinstance(s["charge"], dict) else s["charge"]
+                   for s in stripe_objects]
+        charges = Charge.objects.in_bulk_by_stripe_id(charges)
+        return [cls.stripe_object_to_record(stripe_object, charges)
+                for stripe_object in stripe_objects]
+
+    @classmethod
+    def resolve_owners(cls, instances):
+        """ a refund belongs to the owner of the refunded charge.
+        """
+        for instance in instances:
+            if instance.owner_id is None and instance.charge_id is not None:
+                instance.owner_id = instance.charge.owner_id
+
     def save(self, *args, **kwargs):
         """
         :raises: django.core.exceptions.ValidationError
@@ -722,3 +1154,18 @@ class Refund(StripeModel):
         if not self.is_created:
             type(self).objects.create_resource_from_model(self)
         super().save(*args, **kwargs)
+
+
+class SyncCheckpoint(models.Model):
+    """ the high-water mark of a stripe resource that was mirrored with the
+    `rf_stripe_sync` management command, so the next run only needs to list what is new.
+
+    ``resource`` the name of the stripe resource, e.g. *Charge*.
+    ``cursor`` the unix timestamp of the newest object seen by the last complete run.
+    """
+    resource = models.CharField(max_length=50, unique=True)
+    cursor = models.PositiveIntegerField(null=True)
+    datetime_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "<SyncCheckpoint :: {0}({1})>".format(self.resource, self.cursor)
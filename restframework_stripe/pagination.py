@@ -0,0 +1,166 @@
+""" keyset pagination for the charge, transfer and refund list endpoints, which can hold
+any number of objects per owner. a page is selected by the position of the last (or
+first) object of the previous page instead of an offset, so every page is read with an
+index range scan of `(owner, created, id)` and takes the same time no matter how far into
+the list it is.
+"""
+import base64
+import collections
+import functools
+import json
+import operator
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from . import STRIPE
+
+
+class KeysetPagination(BasePagination):
+    """ pages through a queryset newest first, ordered by `created` and the primary key
+    for models with a `created` field and by the primary key alone otherwise. ties are
+    broken by the primary key, so the ordering is stable and objects created while a
+    client pages through the list are neither skipped nor repeated.
+
+    the response looks like the one of rest framework's CursorPagination::
+
+        {
+            "next": "https://.../charges/?cursor=WyIyMDE2LTAxLTEzVDA1OjI4OjIzKzAwOjAwIiwgMTJd",
+            "previous": null,
+            "results": [...]
+        }
+
+    the page size defaults to the `page_size` setting and can be chosen by the client
+    with `?page_size=`, up to the `max_page_size` setting.
+    """
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    invalid_cursor_message = "Invalid cursor"
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return STRIPE["page_size"]
+        return max(1, min(page_size, STRIPE["max_page_size"]))
+
+    def get_keys(self, queryset):
+        """ :returns: the fields of the keyset, the primary key being the last one
+        """
+        meta = queryset.model._meta
+        keys = [f for f in meta.concrete_fields if f.name == "created"]
+        return keys + [meta.pk]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.keys = self.get_keys(queryset)
+        position, reverse = self.decode_cursor(request)
+
+        # the previous page is read in ascending order, starting at the cursor
+        queryset = queryset.order_by(
+            *[("" if reverse else "-") + key.name for key in self.keys])
+        if position is not None:
+            condition = self.get_keyset_condition(position, reverse)
+            queryset = queryset.filter(condition) if condition else queryset.none()
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        return self.page
+
+    def get_keyset_condition(self, position, reverse):
+        """ build the condition for the objects after the position in the ordering, or
+        before it when paging backwards, i.e. `created < c OR (created = c AND id < i)`.
+        objects without `created` (e.g. not yet backfilled) come first in a descending
+        ordering.
+
+        :returns: a Q object, or None if no object can follow the position
+        """
+        conditions = []
+        # the condition that the previous keys are equal to the position
+        equal = Q()
+        for key, value in zip(self.keys, position):
+            if value is None:
+                beyond = None if reverse else Q(**{key.name + "__isnull": False})
+            elif reverse:
+                beyond = Q(**{key.name + "__gt": value})
+                if key.null:
+                    beyond |= Q(**{key.name + "__isnull": True})
+            else:
+                beyond = Q(**{key.name + "__lt": value})
+            if beyond is not None:
+                conditions.append(equal & beyond if equal else beyond)
+            if value is None:
+                equal &= Q(**{key.name + "__isnull": True})
+            else:
+                equal &= Q(**{key.name: value})
+        if not conditions:
+            return None
+        condition = functools.reduce(operator.or_, conditions)
+
+        # a bound on the first key alone lets the database seek to the position in the
+        # index instead of filtering every object before it
+        first, value = self.keys[0], position[0]
+        if value is not None and not reverse:
+            condition &= Q(**{first.name + "__lte": value})
+        elif value is not None and not first.null:
+            condition &= Q(**{first.name + "__gte": value})
+        return condition
+
+    def encode_cursor(self, instance, reverse):
+        position = []
+        for key in self.keys:
+            value = key.value_from_object(instance)
+            position.append(value.isoformat() if hasattr(value, "isoformat") else value)
+        cursor = json.dumps([position, reverse]).encode("utf-8")
+        cursor = base64.urlsafe_b64encode(cursor).decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request):
+        """ :returns: the position of the cursor and whether it points backwards, the
+            position is None without a cursor
+        """
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+        try:
+            position, reverse = json.loads(
+                base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+            if len(position) != len(self.keys):
+                raise ValueError(cursor)
+            position = [None if value is None else key.to_python(value)
+                        for key, value in zip(self.keys, position)]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return position, bool(reverse)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            # paged past the end, the first page is the best guess
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(collections.OrderedDict([
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            ("results", data),
+            ]))
@@ -0,0 +1,166 @@
+""" a client side token bucket rate limiter for stripe api requests. stripe limits the
+number of requests per second per account, and every worker of a project counts towards
+the same limit. rather than failing with a 429, a request that finds its bucket empty
+waits for its turn.
+
+requests are counted in separate buckets for live and test mode and for every connected
+account (requests made with a `Stripe-Account` header). the limiter is disabled unless
+the `rate_limit` setting is given::
+
+    RESTFRAMEWORK_STRIPE = {
+        "rate_limit": {
+            "backend": "django",  # or "locmem", or a dotted path to a backend class
+            "options": {"alias": "default"},
+            "rate": {"live": 100, "test": 25},  # requests per second
+            "burst": {"live": 100, "test": 25},  # defaults to the rate
+            }
+        }
+
+the "locmem" backend limits the requests of a single process, the "django" backend
+shares the buckets between all processes through one of the projects django caches,
+which should be shared as well (e.g. redis or memcached).
+"""
+import contextlib
+import math
+import random
+import threading
+import time
+import uuid
+
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from . import STRIPE
+
+
+class LocMemBucketBackend:
+    """ buckets kept in the memory of the current process.
+    """
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key, rate, burst):
+        """ take a token from the bucket, which may go negative to queue the request.
+
+        :returns: the number of seconds to wait before the request may be sent
+        """
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate) - 1
+            self._buckets[key] = (tokens, now)
+        return max(0, -tokens / rate)
+
+
+class DjangoCacheBucketBackend:
+    """ buckets kept in one of the projects configured django caches. a bucket is
+    updated while holding a short lock created with `cache.add`, which is atomic on the
+    shared cache backends.
+
+    if the lock can not be taken within `lock_timeout` seconds the bucket is left alone
+    and the request conservatively waits as long as an empty bucket takes to refill.
+    """
+    def __init__(self, alias="default", lock_timeout=1):
+        self.alias = alias
+        self.lock_timeout = lock_timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """ :returns: a context manager that yields whether the lock was taken
+        """
+        lock_key = "{0}:lock".format(key)
+        token = uuid.uuid4().hex
+        deadline = time.time() + self.lock_timeout
+        delay = 0.002
+        # a lock left behind by a crashed process expires after `lock_timeout`
+        expires = max(1, int(math.ceil(self.lock_timeout)))
+        acquired = self.cache.add(lock_key, token, expires)
+        while not acquired and time.time() < deadline:
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, 0.05)
+            acquired = self.cache.add(lock_key, token, expires)
+        try:
+            yield acquired
+        finally:
+            # never release a lock that was taken by someone else
+            if acquired and self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+
+    def reserve(self, key, rate, burst):
+        with self.lock(key) as acquired:
+            if not acquired:
+                return burst / rate
+            now = time.time()
+            tokens, updated = self.cache.get(key) or (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate) - 1
+            # an idle bucket is full again after burst / rate seconds
+            self.cache.set(key, (tokens, now), int(burst / rate) + 60)
+        return max(0, -tokens / rate)
+
+
+BACKENDS = {
+    "locmem": LocMemBucketBackend,
+    "django": DjangoCacheBucketBackend,
+    }
+
+
+class RateLimiter:
+    """ rate limits requests by their api key mode and connected account.
+    """
+    KEY_PREFIX = "rf_stripe:ratelimit"
+    DEFAULT_RATE = {"live": 100, "test": 25}
+
+    def __init__(self, backend=None, rate=None, burst=None):
+        self.backend = backend
+        self.rate = dict(self.DEFAULT_RATE, **(rate or {}))
+        self.burst = dict(self.rate, **(burst or {}))
+
+    @classmethod
+    def from_settings(cls, config):
+        """ build a rate limiter from the `RESTFRAMEWORK_STRIPE["rate_limit"]` setting.
+        """
+        backend = config.get("backend")
+        if backend is not None:
+            if isinstance(backend, str):
+                backend = BACKENDS.get(backend) or import_string(backend)
+            backend = backend(**config.get("options", {}))
+        return cls(backend, config.get("rate"), config.get("burst"))
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def get_bucket(self, api_key=None, account=None):
+        """ :returns: a (bucket key, mode) tuple
+        """
+        mode = "live" if "_live_" in (api_key or "") else "test"
+        key = "{0}:{1}:{2}".format(self.KEY_PREFIX, mode, account or "platform")
+        return key, mode
+
+    def acquire(self, api_key=None, account=None):
+        """ block until a request for the api key and account may be sent.
+
+        :returns: the number of seconds waited
+        """
+        if not self.enabled:
+            return 0
+        key, mode = self.get_bucket(api_key, account)
+        wait = self.backend.reserve(key, self.rate[mode], self.burst[mode])
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def acquire_for_headers(self, headers):
+        """ `acquire` for the headers of a stripe api request.
+        """
+        authorization = headers.get("Authorization", "")
+        api_key = authorization[len("Bearer "):] if authorization else None
+        return self.acquire(api_key, headers.get("Stripe-Account"))
+
+
+rate_limiter = RateLimiter.from_settings(STRIPE["rate_limit"])
@@ -0,0 +1,107 @@
+""" retries for stripe api requests. a request that failed with a network error, a rate
+limit (429) or a server error (5xx) is sent again after an exponential backoff with
+full jitter. create requests are always sent with an idempotency key that is kept for
+every attempt, so a request that timed out after stripe received it can be retried
+without creating a second object.
+
+the number of attempts and the delays are configured per call site with the `retries`
+setting, call sites that are not configured use the "default" budget::
+
+    RESTFRAMEWORK_STRIPE = {
+        "retries": {
+            "default": {"max_attempts": 3, "base_delay": 0.5, "max_delay": 8},
+            "Charge.create": {"max_attempts": 5},
+            "add_payment_source": {"max_attempts": 1},
+            }
+        }
+
+the call sites of this package are "<STRIPE_API_NAME>.create" (e.g. "Plan.create" for
+`StripeModel.stripe_api_create` and the serializers) and "add_payment_source".
+"""
+import random
+import time
+import uuid
+
+import stripe
+
+from . import STRIPE
+from .circuitbreaker import CircuitOpenError
+
+
+DEFAULT_BUDGET = {
+    "max_attempts": 3,
+    "base_delay": 0.5,
+    "max_delay": 8.0,
+    }
+
+
+def make_idempotency_key(*parts):
+    """ an idempotency key for a logical operation. operations that can be identified,
+    such as adding the payment source of a single use token, should pass the identifying
+    parts so that even a request repeated by a client is only executed once.
+    """
+    if not parts:
+        parts = (uuid.uuid4().hex, )
+    return "rf-stripe-{0}".format("-".join(str(p) for p in parts))
+
+
+def is_retryable(err):
+    if isinstance(err, CircuitOpenError):
+        # failing fast is the point of an open circuit
+        return False
+    if isinstance(err, (stripe.APIConnectionError, stripe.RateLimitError)):
+        return True
+    if isinstance(err, stripe.APIError):
+        # an invalid response has no status, anything else is a server error
+        return err.http_status is None or err.http_status >= 500
+    return False
+
+
+class RetryPolicy:
+    """ the retry budget of a call site.
+    """
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def for_call_site(cls, call_site):
+        config = STRIPE["retries"]
+        options = dict(DEFAULT_BUDGET)
+        options.update(config.get("default", {}))
+        options.update(config.get(call_site, {}))
+        return cls(**options)
+
+    def get_delay(self, attempt):
+        """ the delay before the next attempt, after `attempt` failed attempts.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except stripe.StripeError as err:
+                attempt += 1
+                if attempt >= self.max_attempts or not is_retryable(err):
+                    raise
+            time.sleep(self.get_delay(attempt))
+
+
+def call_with_retries(call_site, func, *args, **kwargs):
+    return RetryPolicy.for_call_site(call_site).call(func, *args, **kwargs)
+
+
+def create_with_retries(call_site, create, idempotency_key=None, **params):
+    """ send a create request with an idempotency key, retrying it within the budget of
+    the call site.
+
+    :param create: a stripe create method, e.g. `stripe.Charge.create` or the `create`
+        method of a list object such as `customer.sources`
+    :param idempotency_key: defaults to a new key for this operation
+    """
+    if idempotency_key is None:
+        idempotency_key = make_idempotency_key()
+    return call_with_retries(call_site, create, idempotency_key=idempotency_key, **params)
@@ -12,17 +12,21 @@ no matter what the method, the model serializer will always return data back to
 client. used in conjunction with the `views.StripeResourceViewset` it is easy to perform
 CRUD operatons with these serializers without very verbose views.
 """
+import time
+
 from django.contrib.auth import get_user_model
 
 from rest_framework import serializers
 from rest_framework.fields import empty
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import Throttled, ValidationError
 
 import stripe
 
 from . import models
 from . import util
 from . import STRIPE
+from .cache import stripe_cache
+from .retry import create_with_retries
 
 
 class ReturnSerializerMixin:
@@ -33,6 +37,8 @@ class ReturnSerializerMixin:
     """
     @staticmethod
     def reraise_stripe_error(error):  # pragma: no cover
+        if isinstance(error, stripe.RateLimitError):
+            raise Throttled(detail=error._message)
         if hasattr(error, "param"):
             body = {error.param: error._message}
         else:
@@ -128,11 +134,15 @@ class StripeResourceSerializer(ReturnSerializerMixin, serializers.Serializer):
         data = self._process_data_for_stripe(data)
         # update the retrieved stripe instance
         instance = util.recursive_mapping_update(instance, **data)
+        requested = time.time()
         try:
             instance = instance.save()
         except stripe.StripeError as err:
             self.reraise_stripe_error(err)
         else:
+            stripe_cache.invalidate_object(instance)
+            # `update` records it, so older webhook events are not applied afterwards
+            instance._fetched_at = requested
             return instance
 
     def _process_data_for_stripe(self, data):
@@ -176,7 +186,8 @@ class StripeListObjectSerializer(StripeResourceSerializer):
         data = self._process_data_for_stripe(data)
 
         try:
-            stripe_object = list_object.create(**data)
+            call_site = "{0}.create".format(self.get_model_class().STRIPE_API_NAME)
+            stripe_object = create_with_retries(call_site, list_object.create, **data)
         # an error due to an object not existing, invalid api key, or network outage
         except stripe.StripeError as err:  # pragma: no cover
             self.reraise_stripe_error(err)
@@ -191,24 +202,70 @@ class StripeTokenResourceSerializer(ReturnSerializerMixin, serializers.Serialize
     owner = serializers.PrimaryKeyRelatedField(queryset=get_user_model().objects.all())
 
 
+class StripeModelSerializer(serializers.ModelSerializer):
+    """ the base model serializer of all StripeModels. it takes two optional arguments to
+    prune its fields, see `views.SparseFieldsetMixin`:
+
+    ``fields`` the names of the fields to include. a dotted path into `source`, such as
+    *source.outcome.type*, includes only those attributes of the stripe object.
+
+    ``omit`` the names of the fields to leave out.
+    """
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop("fields", None)
+        omit = kwargs.pop("omit", ())
+        super().__init__(*args, **kwargs)
+
+        self.source_paths = None
+        if fields is not None:
+            names = {name.split(".")[0] for name in fields}
+            if "source" not in fields:
+                self.source_paths = [name.split(".")[1:] for name in fields
+                                     if name.startswith("source.")] or None
+            for field_name in set(self.fields).difference(names):
+                self.fields.pop(field_name)
+        for field_name in omit:
+            self.fields.pop(field_name, None)
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if self.source_paths and data.get("source") is not None:
+            data["source"] = util.select_paths(data["source"], self.source_paths)
+        return data
+
+
 class DefaultSourceRelatedField(serializers.RelatedField):
     """ A Field type for representing payment & payout accounts for merchants and
-    customers
+    customers. To avoid a query per row when serializing many customers, the queryset
+    should prefetch the generic relation, i.e. `prefetch_related("default_source")`,
+    which loads the sources with one query per source type.
     """
-    def to_representation(self, value):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the nested serializers are built once and reused for every row
+        self._serializers = {}
+
+    def get_source_serializer(self, value):
         if isinstance(value, models.BankAccount):
-            return BankAccountSerializer(value).data
+            serializer_class = BankAccountSerializer
         elif isinstance(value, models.Card):
-            return CardSerializer(value).data
-        raise NotImplementedError(value.__class__.__name__)
+            serializer_class = CardSerializer
+        else:
+            raise NotImplementedError(value.__class__.__name__)
+        if serializer_class not in self._serializers:
+            self._serializers[serializer_class] = serializer_class()
+        return self._serializers[serializer_class]
+
+    def to_representation(self, value):
+        return self.get_source_serializer(value).to_representation(value)
 
 
-class CardSerializer(serializers.ModelSerializer):
+class CardSerializer(StripeModelSerializer):
     """
     """
     class Meta:
         model = models.Card
-        exclude = ("stripe_id", )
+        exclude = ("stripe_id", "last_event_created")
 
 
 class CreateCardResourceSerializer(StripeTokenResourceSerializer):
@@ -267,12 +324,12 @@ class UpdateCardResourceSerializer(StripeResourceSerializer):
         return_serializer = CardSerializer
 
 
-class BankAccountSerializer(serializers.ModelSerializer):
+class BankAccountSerializer(StripeModelSerializer):
     """
     """
     class Meta:
         model = models.BankAccount
-        exclude = ("stripe_id", )
+        exclude = ("stripe_id", "last_event_created")
 
 
 class CreateBankAccountResourceSerializer(CreateCardResourceSerializer):
@@ -293,12 +350,12 @@ class UpdateBankAccountResourceSerializer(StripeResourceSerializer):
         return_serializer = BankAccountSerializer
 
 
-class ConnectedAccountSerializer(serializers.ModelSerializer):
+class ConnectedAccountSerializer(StripeModelSerializer):
     """
     """
     class Meta:
         model = models.ConnectedAccount
-        exclude = ("stripe_id", )
+        exclude = ("stripe_id", "last_event_created")
 
 
 class CreateConnectedAccountResourceSerializer(StripeResourceSerializer):
@@ -371,12 +428,12 @@ class UpdateConnectedAccountResourceSerializer(StripeResourceSerializer):
         return instance
 
 
-class SubscriptionSerializer(serializers.ModelSerializer):
+class SubscriptionSerializer(StripeModelSerializer):
     """
     """
     class Meta:
         model = models.Subscription
-        exclude = ("stripe_id", )
+        exclude = ("stripe_id", "last_event_created")
 
 
 class CreateSubscriptionResourceSerializer(StripeListObjectSerializer):
@@ -418,14 +475,14 @@ class UpdateSubscriptionResourceSerializer(StripeResourceSerializer):
 
 # Customers can not be created by clients, this should be explicitly handled on the
 # server side with an event hook after an account has been created.
-class CustomerSerializer(serializers.ModelSerializer):
+class CustomerSerializer(StripeModelSerializer):
     """
     """
     default_source = DefaultSourceRelatedField(allow_null=True, read_only=True)
 
     class Meta:
         model = models.Customer
-        exclude = ("stripe_id", )
+        exclude = ("stripe_id", "last_event_created")
 
 
 class CustomerShippingSerializer(serializers.Serializer):
@@ -475,25 +532,25 @@ class UpdateCustomerResourceSerializer(StripeResourceSerializer):
 
 # READ ONLY OWNED RESOURCES #
 
-class ChargeSerializer(serializers.ModelSerializer):
+class ChargeSerializer(StripeModelSerializer):
     """
     """
     class Meta:
         model = models.Charge
-        exclude = ("stripe_id", )
+        exclude = ("stripe_id", "last_event_created")
 
 
-class TransferSerializer(serializers.ModelSerializer):
+class TransferSerializer(StripeModelSerializer):
     """
     """
     class Meta:
         model = models.Transfer
-        exclude = ("stripe_id", )
+        exclude = ("stripe_id", "last_event_created")
 
 
-class RefundSerializer(serializers.ModelSerializer):
+class RefundSerializer(StripeModelSerializer):
     """
     """
     class Meta:
         model = models.Refund
-        exclude = ("stripe_id", )
+        exclude = ("stripe_id", "last_event_created")
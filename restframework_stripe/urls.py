@@ -14,5 +14,7 @@ router.register(r"charges", views.ChargeViewset, base_name="charge")
 router.register(r"transfers", views.TransferViewset, base_name="transfer")
 router.register(r"refunds", views.RefundViewset, base_name="refund")
 
-urlpatterns = []
+urlpatterns = [
+    url(r"^webhook/$", views.WebhookView.as_view(), name="webhook"),
+    ]
 urlpatterns += router.urls
@@ -1,5 +1,7 @@
+import itertools
 from collections import Mapping, Sequence
 
+
 def recursive_mapping_update(mapping, **updates):
     """ Recursively update a dict-tree without clobbering any of the nested dictionaries.
 
@@ -13,3 +15,55 @@ def recursive_mapping_update(mapping, **updates):
         else:
             mapping[key] = value
     return mapping
+
+
+def select_paths(mapping, paths):
+    """ copy the values at the given paths of a dict-tree, leaving out everything else.
+    paths that do not exist in the mapping are ignored.
+
+    :param paths: a list of key sequences, e.g. `[["outcome", "type"], ["amount"]]`
+    :returns: a new dict-tree
+    """
+    selected = {}
+    for path in paths:
+        value = mapping
+        for key in path:
+            if not isinstance(value, Mapping) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = selected
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+    return selected
+
+
+def chunked(iterable, size):
+    """ split an iterable into lists of at most `size` items without loading all of it.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def list_all(stripe_resource, page_size=100, **params):
+    """ iterate over every object of a stripe list endpoint, requesting one page at a
+    time. `auto_paging_iter` of the supported stripe library versions drops filters such
+    as `created` when requesting the next page, so pages are requested explicitly.
+
+    :param stripe_resource: a listable stripe api class, e.g. `stripe.Charge`
+    :param params: filters passed to every list request
+    """
+    params["limit"] = page_size
+    while True:
+        page = stripe_resource.list(**params)
+        data = page.get("data", [])
+        for stripe_object in data:
+            yield stripe_object
+        if not data or not page.get("has_more"):
+            return
+        params["starting_after"] = data[-1]["id"]
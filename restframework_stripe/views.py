@@ -1,13 +1,102 @@
+from django.contrib.contenttypes.fields import GenericForeignKey
+
 from rest_framework import status
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import detail_route
 
+import stripe
+
 from . import models, serializers, permissions
+from .pagination import KeysetPagination
+from . import STRIPE
+from .cache import stripe_cache
+from .circuitbreaker import CircuitOpenError, circuit_breaker
+from .webhooks import SignatureVerificationError, verify_signature
+
+
+# the http warning for a response that may be out of date (rfc 7234)
+STALE_WARNING = '110 - "Response is Stale"'
 
 
-class StripeResourceViewset(ModelViewSet):
+class StaleReadMixin:
+    """ the local copies served by read endpoints are kept up to date by webhooks and
+    refreshes. while the circuit breaker is open they may be out of date, which is
+    indicated with a `Warning: 110` header.
+    """
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if request.method == "GET" and circuit_breaker.is_open:
+            response["Warning"] = STALE_WARNING
+        return response
+
+
+class SparseFieldsetMixin:
+    """ read endpoints accept `?fields=` and `?omit=`, comma separated lists of the
+    fields to include or to leave out. a dotted path into `source`, e.g.
+    `?fields=id,amount,source.outcome.type`, only includes those attributes of the
+    stripe object. the columns of fields that are left out are not loaded from the
+    database either.
+
+    list endpoints also leave out `source`, the full stripe object is often several KB
+    while the model columns (including the `SOURCE_PROJECTIONS`) are enough for a
+    summary. it is included with `?expand=source` or when it is named in `?fields=`.
+    """
+    fields_query_param = "fields"
+    omit_query_param = "omit"
+    expand_query_param = "expand"
+    deferred_fields = ("source",)
+    # the columns that are always loaded, the permissions check the owner of an object
+    # and the pagination cursor is built from `created`
+    required_fields = ("owner", "created")
+    sparse_actions = ("list", "retrieve")
+
+    def get_query_param_list(self, param):
+        value = self.request.query_params.get(param, "")
+        return [name.strip() for name in value.split(",") if name.strip()]
+
+    def get_field_selection(self):
+        """ :returns: the fields to include, or None for all of them, and the fields to
+            leave out
+        """
+        if self.action not in self.sparse_actions:
+            return None, ()
+        fields = self.get_query_param_list(self.fields_query_param) or None
+        omit = set(self.get_query_param_list(self.omit_query_param))
+        if self.action == "list":
+            expanded = set(self.get_query_param_list(self.expand_query_param))
+            expanded.update(name.split(".")[0] for name in fields or ())
+            omit.update(name for name in self.deferred_fields if name not in expanded)
+        return fields, tuple(sorted(omit))
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        fields, omit = self.get_field_selection()
+        meta = queryset.model._meta
+        columns = {f.name for f in meta.concrete_fields if not f.primary_key}
+        if fields is not None:
+            names = {name.split(".")[0] for name in fields}.difference(omit)
+            names.update(self.required_fields)
+            # the columns of generic relations, such as the default source of a customer,
+            # are always loaded to allow prefetching them
+            for field in meta.get_fields():
+                if isinstance(field, GenericForeignKey):
+                    names.update((field.ct_field, field.fk_field))
+            return queryset.only(*(columns & names))
+        deferred = columns.intersection(omit).difference(self.required_fields)
+        return queryset.defer(*deferred) if deferred else queryset
+
+    def get_serializer(self, *args, **kwargs):
+        fields, omit = self.get_field_selection()
+        if fields is not None:
+            kwargs["fields"] = fields
+        if omit:
+            kwargs["omit"] = omit
+        return super().get_serializer(*args, **kwargs)
+
+
+class StripeResourceViewset(SparseFieldsetMixin, ModelViewSet):
     """ a typical ModelViewSet that chooses its serializer based on the request type.
     this requires that the viewset has two additional parameters, namely
     `create_stripe_serializer` and `update_stripe_serializer`. these serializers will be
@@ -66,6 +155,7 @@ class StripeResourceViewset(ModelViewSet):
 
     def perform_destroy(self, instance):
         stripe_instance = instance.retrieve_stripe_api_instance()
+        stripe_cache.invalidate_object(stripe_instance)
         stripe_instance.delete()
         instance.delete()
 
@@ -76,9 +166,18 @@ class StripeResourceViewset(ModelViewSet):
     def refresh(self, request, *args, **kwargs):
         """ For whatever reason a model might need to be refreshed by a client a detail
         route /<resource>/<pk>/refresh/ is available.
+
+        while the circuit breaker is open the local copy is returned with a
+        `Warning: 110` header instead.
         """
         instance = self.get_object()
-        instance.refresh_from_stripe_api()
+        try:
+            instance.refresh_from_stripe_api()
+        except CircuitOpenError:
+            serializer = self.get_serializer(instance)
+            return Response(serializer.data, headers={"Warning": STALE_WARNING})
+        except stripe.StripeError as err:
+            serializers.ReturnSerializerMixin.reraise_stripe_error(err)
         instance.save()
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
@@ -165,23 +264,25 @@ class SubscriptionViewset(StripeResourceViewset):
         return super().create(request, *args, **kwargs)
 
 
-class CustomerViewset(SingleObjectUpdateOnly, StripeResourceViewset):
+class CustomerViewset(StaleReadMixin, SingleObjectUpdateOnly, StripeResourceViewset):
     """
     """
     model = models.Customer
-    queryset = models.Customer.objects.all()
+    # default sources are loaded with one query per source type, not one per customer
+    queryset = models.Customer.objects.prefetch_related("default_source")
     serializer_class = serializers.CustomerSerializer
     update_stripe_serializer = serializers.UpdateCustomerResourceSerializer
 
     permission_classes = (permissions.CustomerOnlyPermission, )
 
 
-class ChargeViewset(ReadOnlyModelViewSet):
+class ChargeViewset(StaleReadMixin, SparseFieldsetMixin, ReadOnlyModelViewSet):
     """
     """
     model = models.Charge
     queryset = models.Charge.objects.all()
     serializer_class = serializers.ChargeSerializer
+    pagination_class = KeysetPagination
 
     permission_classes = (permissions.CustomerOnlyPermission, )
 
@@ -189,12 +290,13 @@ class ChargeViewset(ReadOnlyModelViewSet):
         return queryset.filter(owner=self.request.user)
 
 
-class TransferViewset(ReadOnlyModelViewSet):
+class TransferViewset(SparseFieldsetMixin, ReadOnlyModelViewSet):
     """
     """
     model = models.Transfer
     queryset = models.Transfer.objects.all()
     serializer_class = serializers.TransferSerializer
+    pagination_class = KeysetPagination
 
     permission_classes = (permissions.MerchantOnlyPermission, )
 
@@ -202,14 +304,62 @@ class TransferViewset(ReadOnlyModelViewSet):
         return queryset.filter(owner=self.request.user)
 
 
-class RefundViewset(ReadOnlyModelViewSet):
+class RefundViewset(SparseFieldsetMixin, ReadOnlyModelViewSet):
     """
     """
     model = models.Refund
     queryset = models.Refund.objects.all()
     serializer_class = serializers.RefundSerializer
+    pagination_class = KeysetPagination
 
     permission_classes = (permissions.CustomerOnlyPermission, )
 
     def filter_queryset(self, queryset):
         return queryset.filter(owner=self.request.user)
+
+
+class WebhookView(APIView):
+    """ The endpoint to configure as your webhook url with stripe. The event is stored
+    and, unless `event_processing` is set to "queue", verified and passed to all
+    registered webhook handlers before responding. In queue mode the event is left for
+    the `rf_stripe_process_events` command.
+
+    When `webhook_verification` is set to "signature" the request is verified with its
+    `Stripe-Signature` header. Requests with an invalid signature are rejected, unless
+    `webhook_verification_fallback` is set in which case the event is stored unverified
+    and verified by retrieving it from stripe when processed.
+    """
+    authentication_classes = ()
+    permission_classes = ()
+
+    def verify_signature(self, request):
+        """ :returns: True if the request was verified by its signature
+        """
+        if STRIPE["webhook_verification"] != "signature":
+            return False
+        try:
+            return verify_signature(request.body,
+                                    request.META.get("HTTP_STRIPE_SIGNATURE"),
+                                    STRIPE["webhook_secrets"],
+                                    STRIPE["webhook_tolerance"])
+        except SignatureVerificationError:
+            if STRIPE["webhook_verification_fallback"]:
+                return False
+            raise
+
+    def post(self, request, *args, **kwargs):
+        try:
+            # the signature is computed over the raw body, read it before parsing
+            verified = self.verify_signature(request)
+        except SignatureVerificationError as err:
+            return Response({"detail": str(err)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            event = models.Event.objects.receive(request.data, verified=verified)
+        except (KeyError, TypeError):
+            return Response({"detail": "Invalid event."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if STRIPE["event_processing"] != "queue":
+            event.process()
+        return Response(status=status.HTTP_200_OK)
@@ -1,28 +1,215 @@
 import collections
+import hashlib
+import hmac
+import threading
+import time
+from concurrent import futures
+
+from django.db import connections
+
+from . import STRIPE
 
 
 class WebhookRegistry:
-    REGISTRY = collections.defaultdict(list)
+    """ handlers are registered for an event type pattern:
+
+    * an exact event type, e.g. `customer.subscription.updated`
+    * a prefix, e.g. `customer` or `customer.subscription.*`, which matches the type
+      itself and every type below it (`customer` matches all `customer.*` events)
+    * the wildcard `*`, which matches every event
+
+    the handlers for a full event type are resolved once and kept in a dispatch index,
+    so calling handlers costs a single dict lookup however many handlers are registered.
+    the index is rebuilt whenever a handler is registered or removed.
 
-    def register(self, *event_types):
+    handlers registered with `independent=True` do not depend on the other handlers
+    for the same event (e.g. sending an email), and are run concurrently on a bounded
+    thread pool of `RESTFRAMEWORK_STRIPE["webhook_workers"]` threads. they use their own
+    database connection, which is closed when they return, and so run outside of the
+    request or processing transaction: they do not see its uncommitted writes, and must
+    not write to the event row (`process_next` keeps it locked until all handlers have
+    returned, which would deadlock).
+    """
+    WILDCARD = "*"
+
+    def __init__(self):
+        self.REGISTRY = collections.defaultdict(list)
+        self.INDEPENDENT = set()
+        self._index = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def normalize(cls, pattern):
+        if pattern.endswith(".*"):
+            return pattern[:-2]
+        return pattern
+
+    def register(self, *event_types, independent=False):
         """ register a webhook handler
         """
         def wrapper(handler):
             for e in event_types:
-                self.REGISTRY[e].append(handler)
+                self.REGISTRY[self.normalize(e)].append(handler)
+            if independent:
+                self.INDEPENDENT.add(handler)
+            self._index.clear()
             return handler
         return wrapper
 
-    def call_handlers(self, event, data, event_type, event_subtype):
-        """ calls all the handlers for a given event type
+    def get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(
+                    max_workers=STRIPE["webhook_workers"])
+            return self._executor
+
+    def resolve(self, event_type):
+        """ the handlers for a full event type, e.g. `customer.subscription.updated`, in
+        order from the least to the most specific pattern.
         """
-        for handler in self.REGISTRY[event_type]:
-            handler(event, data, event_subtype)
+        try:
+            return self._index[event_type]
+        except KeyError:
+            pass
+
+        parts = event_type.split(".")
+        patterns = [self.WILDCARD]
+        patterns += [".".join(parts[:i]) for i in range(1, len(parts) + 1)]
+        handlers = []
+        for pattern in patterns:
+            for handler in self.REGISTRY.get(pattern, ()):
+                if handler not in handlers:
+                    handlers.append(handler)
+        self._index[event_type] = handlers = tuple(handlers)
+        return handlers
+
+    def build_index(self):
+        """ resolve every registered event type up front, called when the app is ready.
+        """
+        for pattern in list(self.REGISTRY):
+            if pattern != self.WILDCARD:
+                self.resolve(pattern)
+
+    def call_handlers(self, event, data, event_type, event_subtype, retry=None):
+        """ calls all the handlers for a given event type. independent handlers are
+        submitted to the thread pool first, then the remaining handlers are called in
+        order. an error raised by an ordered handler stops the remaining ordered
+        handlers, while errors raised by independent handlers are collected.
+
+        :param retry: the names (see `handler_name`) of the independent handlers that
+            failed before, only those are called and the ordered handlers are skipped
+        :returns: a list of (handler, exception) tuples for failed independent handlers
+        """
+        full_type = event_type
+        if event_subtype:
+            full_type = "{0}.{1}".format(event_type, event_subtype)
+        handlers = self.resolve(full_type)
+        if retry is not None:
+            handlers = [handler for handler in handlers if handler in self.INDEPENDENT and
+                        handler_name(handler) in retry]
+
+        pending = []
+        for handler in handlers:
+            if handler in self.INDEPENDENT:
+                future = self.get_executor().submit(
+                    call_independent, handler, event, data, event_subtype)
+                pending.append((handler, future))
+
+        try:
+            for handler in handlers:
+                if handler not in self.INDEPENDENT:
+                    handler(event, data, event_subtype)
+        finally:
+            futures.wait([future for _, future in pending])
+
+        return [(handler, future.exception()) for handler, future in pending
+                if future.exception() is not None]
 
     def remove_handler(self, event_type, handler):
-        reg = self.REGISTRY[event_type]
+        reg = self.REGISTRY[self.normalize(event_type)]
         idx = reg.index(handler)
-        return reg.pop(idx)
+        self._index.clear()
+        handler = reg.pop(idx)
+        if not any(handler in r for r in self.REGISTRY.values()):
+            self.INDEPENDENT.discard(handler)
+        return handler
+
+
+def handler_name(handler):
+    """ the dotted path of a handler, e.g. `myapp.webhooks.send_receipt`, which identifies
+    it across processes.
+    """
+    try:
+        return "{0}.{1}".format(handler.__module__, handler.__qualname__)
+    except AttributeError:
+        return repr(handler)
+
+
+def call_independent(handler, *args):
+    """ call an independent handler on a pool thread, closing the database connections
+    the thread opened so they do not outlive the handler.
+    """
+    try:
+        return handler(*args)
+    finally:
+        for connection in connections.all():
+            connection.close()
 
 
 webhooks = WebhookRegistry()
+
+
+class SignatureVerificationError(Exception):
+    """ raised when the `Stripe-Signature` header of a webhook request does not match
+    its payload.
+    """
+
+
+def compute_signature(payload, timestamp, secret):
+    """ the v1 scheme signature of a webhook payload: an HMAC-SHA256 of
+    "<timestamp>.<payload>" keyed with the endpoint secret.
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode("utf-8")
+    signed_payload = "{0}.{1}".format(timestamp, payload)
+    return hmac.new(secret.encode("utf-8"), signed_payload.encode("utf-8"),
+                    hashlib.sha256).hexdigest()
+
+
+def verify_signature(payload, header, secrets, tolerance=300):
+    """ verify a webhook request with the `Stripe-Signature` header instead of retrieving
+    the event from stripe. a header looks like `t=1492774577,v1=5257a8...,v1=...` and may
+    hold several signatures, and several endpoint secrets may be active at once while a
+    secret is being rolled, so the payload is valid if any signature matches any secret.
+
+    :param payload: the raw request body
+    :param header: the value of the `Stripe-Signature` header
+    :param secrets: a list of endpoint secrets (`whsec_...`)
+    :param tolerance: the maximum age of the signature in seconds, None to disable.
+    :raises: SignatureVerificationError
+    """
+    if not header:
+        raise SignatureVerificationError("No signature header.")
+    if isinstance(secrets, str):
+        secrets = [secrets]
+
+    timestamp, signatures = None, []
+    for item in header.split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1":
+            signatures.append(value)
+
+    if timestamp is None or not timestamp.isdigit() or not signatures:
+        raise SignatureVerificationError("Malformed signature header.")
+    if tolerance is not None and abs(time.time() - int(timestamp)) > tolerance:
+        raise SignatureVerificationError("Timestamp outside the tolerance zone.")
+
+    for secret in secrets:
+        expected = compute_signature(payload, timestamp, secret)
+        if any(hmac.compare_digest(expected, s) for s in signatures):
+            return True
+    raise SignatureVerificationError("No signatures found matching the expected "
+                                     "signature for payload.")
@@ -8,6 +8,7 @@ from model_mommy import mommy
 
 from restframework_stripe import models
 from restframework_stripe.test import get_mock_resource
+from restframework_stripe.webhooks import webhooks
 
 
 @pytest.fixture
@@ -177,3 +178,21 @@ def bank_account(request):
 @pytest.fixture
 def api_client():
     return APIClient()
+
+
+@pytest.fixture(autouse=True)
+def webhook_handlers(request):
+    """ drop the handlers a test registers with the global registry, so that they are
+    not called for the events of later tests.
+    """
+    registry = {event_type: list(handlers)
+                for event_type, handlers in webhooks.REGISTRY.items()}
+    independent = set(webhooks.INDEPENDENT)
+
+    def fin():
+        webhooks.REGISTRY.clear()
+        webhooks.REGISTRY.update(registry)
+        webhooks.INDEPENDENT.clear()
+        webhooks.INDEPENDENT.update(independent)
+        webhooks._index.clear()
+    request.addfinalizer(fin)
@@ -0,0 +1,57 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from restframework_stripe import STRIPE, aio, models
+from restframework_stripe.test import get_mock_resource
+
+
+@mock.patch("stripe.Charge.retrieve")
+def test_aget_stripe_api_instance(charge_retrieve):
+    charge_retrieve.side_effect = lambda stripe_id: get_mock_resource("Charge", id=stripe_id)
+    stripe_ids = ["ch_{}".format(i) for i in range(10)]
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    tasks = [models.Charge.aget_stripe_api_instance(i) for i in stripe_ids]
+    results = loop.run_until_complete(asyncio.gather(*tasks, loop=loop))
+    loop.close()
+
+    assert [r["id"] for r in results] == stripe_ids
+    assert charge_retrieve.call_count == 10
+
+
+@mock.patch("stripe.Charge.retrieve")
+@pytest.mark.django_db
+def test_arefresh_from_stripe_api(charge_retrieve, charge):
+    charge_retrieve.return_value = get_mock_resource("Charge", status="failed")
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(charge.arefresh_from_stripe_api())
+    loop.close()
+
+    assert charge.status == "failed"
+
+
+def test_semaphores_do_not_keep_closed_loops():
+    closed = asyncio.new_event_loop()
+    aio.get_semaphore(closed)
+    closed.close()
+    loop = asyncio.new_event_loop()
+    aio.get_semaphore(loop)
+
+    assert closed not in list(aio._semaphores)
+    assert loop in aio._semaphores
+    loop.close()
+
+
+def test_executor_follows_the_concurrency_setting():
+    executor = aio.get_executor()
+    assert aio.get_executor() is executor
+
+    with mock.patch.dict(STRIPE, async_concurrency=aio.get_concurrency() + 1):
+        resized = aio.get_executor()
+        assert resized is not executor
+        assert resized._max_workers == STRIPE["async_concurrency"]
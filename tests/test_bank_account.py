@@ -55,7 +55,7 @@ def test_customer_adding_bank_account(customer_retrieve_mock, ba_create_mock,
 
 @mock.patch("stripe.Account.retrieve")
 @mock.patch("stripe.BankAccount.save")
-@mock.patch("stripe.ListObject.retrieve")
+@mock.patch("stripe.BankAccount.refresh")
 @pytest.mark.django_db
 def test_bank_account_update(
         bank_account_retrieve,
@@ -73,9 +73,8 @@ def test_bank_account_update(
         "default_for_currency": True,
         }
 
-    bank_account_retrieve.return_value = bank_account.source
+    bank_account_retrieve.return_value = get_mock_resource("BankAccount")
     bank_account_update.return_value = get_mock_resource("BankAccount", **data)
-    account_retrieve.return_value = managed_account.source
 
     uri = reverse("rf_stripe:bank-account-detail", kwargs={"pk": bank_account.pk})
     response = api_client.patch(uri, data=data, format="json")
@@ -83,11 +82,12 @@ def test_bank_account_update(
     bank_account.refresh_from_db()
     assert response.status_code == 200, response.data
     assert bank_account.source["default_for_currency"] is True
+    assert not account_retrieve.called
 
 
 @mock.patch("stripe.Customer.retrieve")
 @mock.patch("stripe.BankAccount.delete")
-@mock.patch("stripe.ListObject.retrieve")
+@mock.patch("stripe.BankAccount.refresh")
 @pytest.mark.django_db
 def test_bank_account_delete(
         bank_account_retrieve,
@@ -103,8 +103,8 @@ def test_bank_account_delete(
     bank_account.save()
 
     api_client.force_authenticate(bank_account.owner)
-    bank_account_retrieve.return_value = bank_account.source
-    customer_retrieve.return_value = customer.source
+    bank_account_retrieve.return_value = get_mock_resource("BankAccount",
+                                                            customer=customer.stripe_id)
     bank_account_delete.return_value = None  # no one cares about this value... EVER
 
     uri = reverse("rf_stripe:bank-account-detail", kwargs={"pk": bank_account.pk})
@@ -112,10 +112,11 @@ def test_bank_account_delete(
 
     assert response.status_code == 204
     assert not models.BankAccount.objects.filter(id=bank_account.id).exists()
+    assert not customer_retrieve.called
 
 
 @mock.patch("stripe.Customer.retrieve")
-@mock.patch("stripe.ListObject.retrieve")
+@mock.patch("stripe.BankAccount.refresh")
 @pytest.mark.django_db
 def test_bank_account_refresh(
         bank_account_retrieve,
@@ -130,7 +131,6 @@ def test_bank_account_refresh(
     bank_account.save()
 
     api_client.force_authenticate(bank_account.owner)
-    customer_retrieve.return_value = customer.source
     bank_account_retrieve.return_value = get_mock_resource("BankAccount",
                                                             status="verification_failed")
     uri = reverse("rf_stripe:bank-account-refresh", kwargs={"pk": bank_account.pk})
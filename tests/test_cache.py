@@ -0,0 +1,117 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+import stripe
+
+from restframework_stripe.cache import LocMemBackend, StripeObjectCache
+from restframework_stripe.test import get_mock_resource
+
+
+@pytest.fixture
+def stripe_cache():
+    return StripeObjectCache(LocMemBackend(max_entries=10), default_ttl=60)
+
+
+def test_locmem_backend_evicts_least_recently_used():
+    backend = LocMemBackend(max_entries=2)
+    backend.set("a", 1, 60)
+    backend.set("b", 2, 60)
+    backend.get("a")
+    backend.set("c", 3, 60)
+
+    assert backend.get("a") == 1
+    assert backend.get("b") is None
+    assert backend.get("c") == 3
+
+
+def test_locmem_backend_expires_entries():
+    backend = LocMemBackend()
+    backend.set("a", 1, -1)
+    assert backend.get("a") is None
+
+
+@mock.patch("stripe.Customer.retrieve")
+def test_read_through(customer_retrieve, stripe_cache):
+    customer_retrieve.return_value = get_mock_resource("Customer")
+
+    first = stripe_cache.retrieve(stripe.Customer, "cus_7i7PcjtB5sFNhL")
+    second = stripe_cache.retrieve(stripe.Customer, "cus_7i7PcjtB5sFNhL")
+
+    assert customer_retrieve.call_count == 1
+    assert first["id"] == second["id"]
+    assert first is not second
+    assert stripe_cache.stats()["hits"] == 1
+    assert stripe_cache.stats()["misses"] == 1
+
+
+@mock.patch("stripe.Customer.retrieve")
+def test_expand_is_part_of_the_key(customer_retrieve, stripe_cache):
+    customer_retrieve.return_value = get_mock_resource("Customer")
+
+    stripe_cache.retrieve(stripe.Customer, "cus_7i7PcjtB5sFNhL")
+    stripe_cache.retrieve(stripe.Customer, "cus_7i7PcjtB5sFNhL", expand=["default_source"])
+
+    assert customer_retrieve.call_count == 2
+
+
+@mock.patch("stripe.Customer.retrieve")
+def test_invalidate(customer_retrieve, stripe_cache):
+    customer_retrieve.return_value = get_mock_resource("Customer")
+
+    stripe_cache.retrieve(stripe.Customer, "cus_7i7PcjtB5sFNhL")
+    stripe_cache.invalidate_object(get_mock_resource("Card", customer="cus_7i7PcjtB5sFNhL"))
+    stripe_cache.retrieve(stripe.Customer, "cus_7i7PcjtB5sFNhL")
+
+    assert customer_retrieve.call_count == 2
+
+
+@mock.patch("stripe.Customer.retrieve")
+def test_zero_ttl_is_not_cached(customer_retrieve):
+    customer_retrieve.return_value = get_mock_resource("Customer")
+    stripe_cache = StripeObjectCache(LocMemBackend(), ttl={"Customer": 0})
+
+    stripe_cache.retrieve(stripe.Customer, "cus_7i7PcjtB5sFNhL")
+    stripe_cache.retrieve(stripe.Customer, "cus_7i7PcjtB5sFNhL")
+
+    assert customer_retrieve.call_count == 2
+
+
+@mock.patch("stripe.Customer.retrieve")
+def test_concurrent_retrieves_are_coalesced(customer_retrieve):
+    def slow_retrieve(stripe_id, **kwargs):
+        time.sleep(0.1)
+        return get_mock_resource("Customer")
+    customer_retrieve.side_effect = slow_retrieve
+    stripe_cache = StripeObjectCache()
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        jobs = [pool.submit(stripe_cache.retrieve, stripe.Customer, "cus_7i7PcjtB5sFNhL")
+                for _ in range(4)]
+        results = [job.result() for job in jobs]
+
+    assert customer_retrieve.call_count == 1
+    assert stripe_cache.stats()["coalesced"] == 3
+    assert len({id(result) for result in results}) == 4
+    # mutating one result does not affect the others
+    results[0].pop("id")
+    assert all(result["id"] == "cus_7i7PcjtB5sFNhL" for result in results[1:])
+
+
+@mock.patch("stripe.Customer.retrieve")
+def test_lock_waits_for_another_process(customer_retrieve):
+    backend = LocMemBackend()
+    stripe_cache = StripeObjectCache(backend, default_ttl=60, lock_timeout=1)
+    other_process = StripeObjectCache(backend, default_ttl=60)
+    key = stripe_cache.make_key("Customer", "cus_7i7PcjtB5sFNhL")
+    backend.add("{0}:lock".format(key), 1, 1)
+    # the process holding the lock fills the cache while this one waits
+    threading.Timer(0.1, other_process.set,
+                    ("Customer", get_mock_resource("Customer"))).start()
+
+    stripe_object = stripe_cache.retrieve(stripe.Customer, "cus_7i7PcjtB5sFNhL")
+
+    assert stripe_object["id"] == "cus_7i7PcjtB5sFNhL"
+    assert not customer_retrieve.called
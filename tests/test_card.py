@@ -86,7 +86,7 @@ def test_card_create_error(card_create, customer_retrieve, customer, api_client)
 
 @mock.patch("stripe.Customer.retrieve")
 @mock.patch("stripe.Card.save")
-@mock.patch("stripe.ListObject.retrieve")
+@mock.patch("stripe.Card.refresh")
 @pytest.mark.django_db
 def test_card_update(
         card_retrieve,
@@ -108,8 +108,7 @@ def test_card_update(
         "exp_year": 2019
         }
 
-    customer_retrieve.return_value = customer.source
-    card_retrieve.return_value = card.source
+    card_retrieve.return_value = get_mock_resource("Card", customer=customer.stripe_id)
     card_update.return_value = get_mock_resource("Card", **data)
 
     uri = reverse("rf_stripe:card-detail", kwargs={"pk": card.pk})
@@ -117,6 +116,8 @@ def test_card_update(
 
     card.refresh_from_db()
     assert response.status_code == 200
+    # the card is addressed directly, without retrieving the customer first
+    assert not customer_retrieve.called
     assert card.source["name"] == data["name"]
     assert card.source["exp_month"] == data["exp_month"]
     assert card.source["exp_year"] == data["exp_year"]
@@ -124,7 +125,7 @@ def test_card_update(
 
 @mock.patch("stripe.Customer.retrieve")
 @mock.patch("stripe.Card.delete")
-@mock.patch("stripe.ListObject.retrieve")
+@mock.patch("stripe.Card.refresh")
 @pytest.mark.django_db
 def test_card_delete(
         card_retrieve,
@@ -141,8 +142,7 @@ def test_card_delete(
 
     api_client.force_authenticate(card.owner)
 
-    customer_retrieve = customer.source
-    card_retrieve.return_value = card.source
+    card_retrieve.return_value = get_mock_resource("Card", customer=customer.stripe_id)
     card_delete.return_value = None  # no one cares about this value... EVER
 
     uri = reverse("rf_stripe:card-detail", kwargs={"pk": card.pk})
@@ -150,6 +150,26 @@ def test_card_delete(
 
     assert response.status_code == 204
     assert not models.Card.objects.filter(id=card.id).exists()
+    assert not customer_retrieve.called
+
+
+@mock.patch("stripe.Customer.retrieve")
+@mock.patch("stripe.ListObject.retrieve")
+@pytest.mark.django_db
+def test_card_retrieve_without_stored_owner(card_retrieve, customer_retrieve, customer,
+                                            card):
+    card.owner = customer.owner
+    card.source.pop("account", None)
+    card.source.pop("customer", None)
+    card.save()
+
+    customer_retrieve.return_value = get_mock_resource("Customer")
+    card_retrieve.return_value = get_mock_resource("Card")
+
+    instance = card.retrieve_stripe_api_instance()
+
+    assert customer_retrieve.called
+    assert instance["id"] == card_retrieve.return_value["id"]
 
 
 @pytest.mark.django_db
@@ -158,3 +178,15 @@ def test_options(user, api_client):
     uri = reverse("rf_stripe:card-list")
     response = api_client.options(uri)
     assert response.status_code == 200, response.data
+
+
+@pytest.mark.django_db
+def test_list(customer, card, api_client):
+    card.owner = customer.owner
+    card.save()
+    api_client.force_authenticate(customer.owner)
+
+    response = api_client.get(reverse("rf_stripe:card-list"))
+
+    assert response.status_code == 200, response.data
+    assert [c["id"] for c in response.data] == [card.pk]
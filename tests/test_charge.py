@@ -1,5 +1,8 @@
+from datetime import datetime
 from unittest import mock
 
+from django.utils import timezone
+
 import pytest
 import stripe
 from model_mommy import mommy
@@ -66,9 +69,127 @@ def test_transfer_retrieve(customer, charge, api_client):
     assert response.status_code == 200, response.data
 
 
+@pytest.mark.django_db
+def test_list_defers_source(customer, charge, api_client):
+    api_client.force_authenticate(customer.owner)
+    charge.owner = customer.owner
+    charge.save()
+    uri = reverse("rf_stripe:charge-list")
+
+    response = api_client.get(uri)
+    assert response.status_code == 200, response.data
+    assert "source" not in response.data["results"][0]
+    assert response.data["results"][0]["amount"] == charge.amount
+
+    response = api_client.get(uri, {"expand": "source"})
+    assert response.data["results"][0]["source"] == charge.source
+
+    response = api_client.get(reverse("rf_stripe:charge-detail", kwargs={"pk": charge.pk}))
+    assert response.data["source"] == charge.source
+
+
+@pytest.mark.django_db
+def test_sparse_fieldsets(customer, charge, api_client):
+    api_client.force_authenticate(customer.owner)
+    charge.owner = customer.owner
+    charge.source["outcome"] = {"type": "authorized", "risk_level": "normal"}
+    charge.save()
+    uri = reverse("rf_stripe:charge-detail", kwargs={"pk": charge.pk})
+
+    response = api_client.get(uri, {"fields": "id,amount,source.outcome.type,source.nope"})
+    assert response.status_code == 200, response.data
+    assert response.data == {"id": charge.pk, "amount": charge.amount,
+                             "source": {"outcome": {"type": "authorized"}}}
+
+    response = api_client.get(uri, {"omit": "source,status"})
+    assert "source" not in response.data and "status" not in response.data
+    assert response.data["currency"] == charge.currency
+
+    response = api_client.get(reverse("rf_stripe:charge-list"),
+                              {"fields": "id,source.amount"})
+    assert response.data["results"] == [
+        {"id": charge.pk, "source": {"amount": charge.source["amount"]}}]
+
+
+@pytest.mark.django_db
+def test_list_pagination(customer, api_client):
+    api_client.force_authenticate(customer.owner)
+    created = [datetime(2016, 1, 1, tzinfo=timezone.utc),
+               datetime(2016, 1, 2, tzinfo=timezone.utc),
+               datetime(2016, 1, 2, tzinfo=timezone.utc),
+               None]
+    charges = [mommy.make(models.Charge, owner=customer.owner, created=c,
+                          source=get_mock_resource("Charge", id="ch_{0}".format(i)),
+                          stripe_id="ch_{0}".format(i))
+               for i, c in enumerate(created)]
+    mommy.make(models.Charge, stripe_id="ch_other", source=get_mock_resource("Charge"))
+    expected = [charges[3].pk, charges[2].pk, charges[1].pk, charges[0].pk]
+
+    response = api_client.get(reverse("rf_stripe:charge-list"), {"page_size": 3})
+    assert list(response.data) == ["next", "previous", "results"]
+    assert [c["id"] for c in response.data["results"]] == expected[:3]
+    assert response.data["previous"] is None
+
+    response = api_client.get(response.data["next"])
+    assert [c["id"] for c in response.data["results"]] == expected[3:]
+    assert response.data["next"] is None
+
+    response = api_client.get(response.data["previous"])
+    assert [c["id"] for c in response.data["results"]] == expected[:3]
+    assert response.data["previous"] is None
+
+    response = api_client.get(reverse("rf_stripe:charge-list"), {"page_size": 2})
+    response = api_client.get(response.data["next"])
+    assert [c["id"] for c in response.data["results"]] == expected[2:]
+
+    response = api_client.get(reverse("rf_stripe:charge-list"), {"cursor": "nope"})
+    assert response.status_code == 404
+
+
 @pytest.mark.django_db
 def test_options(customer, api_client):
     api_client.force_authenticate(customer.owner)
     uri = reverse("rf_stripe:charge-list")
     response = api_client.options(uri)
     assert response.status_code == 200, response.data
+
+
+@pytest.mark.django_db
+def test_source_projections(card):
+    stripe_object = get_mock_resource("Charge")
+    # an expanded customer is projected to its id
+    stripe_object["customer"] = {"id": "cus_4UbFSo9tl62jqj", "object": "customer"}
+    charge = models.Charge.stripe_object_to_model(stripe_object)
+
+    assert charge.amount == 3000
+    assert charge.currency == "usd"
+    assert charge.created.timestamp() == 1452662903
+    assert charge.paid is False
+    assert charge.customer_stripe_id == "cus_4UbFSo9tl62jqj"
+
+
+@pytest.mark.django_db
+def test_backfill_projections(charge):
+    models.Charge.objects.filter(pk=charge.pk).update(amount=None, created=None)
+
+    assert models.Charge.objects.backfill_projections(batch_size=2) == 1
+
+    charge.refresh_from_db()
+    assert charge.amount == charge.source["amount"]
+    assert charge.created.timestamp() == charge.source["created"]
+    assert charge.customer_stripe_id == charge.source["customer"]
+
+
+@mock.patch("stripe.Charge.retrieve")
+@pytest.mark.django_db
+def test_refresh_guards_against_older_events(charge_retrieve, charge):
+    charge_retrieve.return_value = get_mock_resource("Charge", id=charge.stripe_id,
+                                                     status="refunded")
+    charge.refresh_from_stripe_api()
+    charge.save()
+    assert charge.last_event_created is not None
+
+    stale = dict(get_mock_resource("Charge", id=charge.stripe_id), status="pending")
+    assert not charge.apply_stripe_object(stale, event_created=1452662903)
+    charge.refresh_from_db()
+    assert charge.status == "refunded"
@@ -0,0 +1,122 @@
+from unittest import mock
+
+from django.core.cache import caches
+
+import pytest
+import requests
+import stripe
+
+from restframework_stripe import client
+from restframework_stripe.circuitbreaker import CircuitBreaker, CircuitOpenError
+from restframework_stripe.client import PooledRequestsClient
+from restframework_stripe.ratelimit import (
+    DjangoCacheBucketBackend, LocMemBucketBackend, RateLimiter)
+
+
+def test_pooled_client_is_installed():
+    assert isinstance(stripe.default_http_client, PooledRequestsClient)
+
+
+@mock.patch("requests.Session.request")
+def test_pooled_client_reuses_session(session_request):
+    session_request.return_value = mock.Mock(content=b"{}", status_code=200, headers={})
+    http_client = PooledRequestsClient(connect_timeout=1, read_timeout=2)
+
+    http_client.request("get", "https://api.stripe.com/v1/customers", {})
+    http_client.request("get", "https://api.stripe.com/v1/customers", {})
+
+    assert session_request.call_count == 2
+    assert session_request.call_args[1]["timeout"] == (1, 2)
+
+
+@mock.patch("requests.Session.request")
+def test_pooled_client_connection_error(session_request):
+    session_request.side_effect = requests.exceptions.ConnectionError("nope")
+    http_client = PooledRequestsClient()
+
+    with pytest.raises(stripe.error.APIConnectionError):
+        http_client.request("get", "https://api.stripe.com/v1/customers", {})
+
+
+def test_pooled_client_without_keep_alive():
+    http_client = PooledRequestsClient(keep_alive=False)
+    assert http_client.session.headers["Connection"] == "close"
+
+
+@mock.patch("requests.Session.post")
+def test_post_uses_pooled_session(session_post):
+    client.post("https://connect.stripe.com/oauth/token", params={})
+    assert session_post.called
+
+
+def test_rate_limiter_queues_requests():
+    limiter = RateLimiter(LocMemBucketBackend(), rate={"test": 100}, burst={"test": 2})
+
+    waits = [limiter.acquire("sk_test_123") for _ in range(4)]
+
+    assert waits[:2] == [0, 0]
+    assert all(0 < wait <= 0.03 for wait in waits[2:])
+
+
+def test_rate_limiter_buckets():
+    limiter = RateLimiter(LocMemBucketBackend())
+
+    assert limiter.get_bucket("sk_live_123")[1] == "live"
+    assert limiter.get_bucket("sk_test_123")[1] == "test"
+    assert limiter.get_bucket("sk_live_123", "acct_1") != limiter.get_bucket("sk_live_123")
+
+
+@mock.patch("requests.Session.request")
+def test_pooled_client_acquires_rate_limit(session_request):
+    session_request.return_value = mock.Mock(content=b"{}", status_code=200, headers={})
+    limiter = mock.Mock()
+    http_client = PooledRequestsClient(rate_limiter=limiter)
+    headers = {"Authorization": "Bearer sk_test_123", "Stripe-Account": "acct_1"}
+
+    http_client.request("get", "https://api.stripe.com/v1/customers", headers)
+
+    limiter.acquire_for_headers.assert_called_with(headers)
+
+
+@mock.patch("time.monotonic")
+def test_circuit_breaker(monotonic):
+    monotonic.return_value = 0
+    breaker = CircuitBreaker(window=4, min_requests=4, failure_rate=0.5, reset_timeout=30)
+
+    for failed in (False, True, False, True):
+        breaker.before_request()
+        breaker.record(failed)
+    assert breaker.state == breaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    monotonic.return_value = 30
+    breaker.before_request()  # the trial request
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    breaker.record(False)
+    assert breaker.state == breaker.CLOSED
+
+
+def test_circuit_breaker_counts_slow_requests():
+    breaker = CircuitBreaker(window=2, min_requests=2, failure_rate=1, slow_call_duration=1)
+    breaker.record(False, duration=2)
+    breaker.record(False, duration=3)
+    assert breaker.is_open
+
+
+def test_django_cache_bucket_lock_timeout():
+    backend = DjangoCacheBucketBackend(lock_timeout=0.05)
+    cache = caches["default"]
+    cache.set("bucket:lock", "other", 60)
+    try:
+        assert backend.reserve("bucket", rate=10, burst=5) == 0.5
+        # the lock of the other process is left alone and the bucket untouched
+        assert cache.get("bucket:lock") == "other"
+        assert cache.get("bucket") is None
+    finally:
+        cache.delete("bucket:lock")
+
+    assert backend.reserve("bucket", rate=10, burst=5) == 0
+    assert cache.get("bucket:lock") is None
+    cache.delete("bucket")
@@ -1,5 +1,11 @@
+import io
 from unittest import mock
 
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 import pytest
 import stripe
 from model_mommy import mommy
@@ -7,6 +13,8 @@ from model_mommy import mommy
 from rest_framework.reverse import reverse
 
 from restframework_stripe import models
+from restframework_stripe.circuitbreaker import CircuitOpenError
+from restframework_stripe.serializers import CustomerSerializer
 from restframework_stripe.test import get_mock_resource
 
 
@@ -113,3 +121,112 @@ def test_options(customer, api_client):
     uri = reverse("rf_stripe:customer-list")
     response = api_client.options(uri)
     assert response.status_code == 200, response.data
+
+
+@pytest.mark.django_db
+def test_list(customer, api_client):
+    api_client.force_authenticate(customer.owner)
+    response = api_client.get(reverse("rf_stripe:customer-list"))
+    assert response.status_code == 200, response.data
+    assert [c["id"] for c in response.data] == [customer.pk]
+
+
+@mock.patch("stripe.Customer.create")
+@pytest.mark.django_db
+def test_rf_stripe_customers_command(customer_create, user):
+    customer_create.return_value = get_mock_resource("Customer", default_source=None)
+
+    call_command("rf_stripe_customers", chunk_size=10)
+
+    assert models.Customer.objects.filter(owner=user).exists()
+    assert customer_create.call_args[1]["idempotency_key"] == \
+        "rf-stripe-customer-{0}".format(user.pk)
+
+
+@mock.patch("stripe.Customer.create")
+@pytest.mark.django_db
+def test_rf_stripe_customers_command_insert_failure(customer_create, user):
+    other = mommy.make(settings.AUTH_USER_MODEL, username="other")
+    mommy.make(models.Customer, stripe_id="cus_taken",
+               source=get_mock_resource("Customer", id="cus_taken"))
+    customer_create.side_effect = lambda **kwargs: get_mock_resource(
+        "Customer", default_source=None,
+        id="cus_taken" if kwargs["metadata"]["user_id"] == other.pk else "cus_new")
+    out, err = io.StringIO(), io.StringIO()
+
+    call_command("rf_stripe_customers", chunk_size=10, stdout=out, stderr=err)
+
+    # the failing row does not take the rest of the chunk with it
+    assert models.Customer.objects.get(owner=user).stripe_id == "cus_new"
+    assert not models.Customer.objects.filter(owner=other).exists()
+    assert "Created 1 customers, 1 failed." in out.getvalue()
+    assert "cus_taken" in err.getvalue()
+
+
+@pytest.mark.django_db
+def test_serialize_customers_default_source_queries():
+    def make_customers(start, stop):
+        for i in range(start, stop):
+            card = mommy.make(models.Card, stripe_id="card_{}".format(i),
+                              source=get_mock_resource("Card"))
+            mommy.make(models.Customer, stripe_id="cus_{}".format(i),
+                       source=get_mock_resource("Customer"), default_source=card)
+
+    def count_queries():
+        queryset = models.Customer.objects.prefetch_related("default_source")
+        with CaptureQueriesContext(connection) as queries:
+            data = CustomerSerializer(queryset, many=True).data
+        return len(data), len(queries)
+
+    make_customers(0, 2)
+    rows, few = count_queries()
+    make_customers(2, 5)
+    more_rows, many = count_queries()
+
+    assert (rows, more_rows) == (2, 5)
+    assert few == many
+
+
+@pytest.mark.django_db
+def test_stripe_objects_to_models(card, bank_account):
+    stripe_objects = [
+        get_mock_resource("Customer", id="cus_1", default_source=card.source),
+        get_mock_resource("Customer", id="cus_2", default_source=bank_account.source),
+        get_mock_resource("Customer", id="cus_3", default_source="card_notexpanded"),
+        ]
+    with CaptureQueriesContext(connection) as queries:
+        customers = models.Customer.stripe_objects_to_models(stripe_objects)
+
+    assert len(queries) == 2
+    assert [c.stripe_id for c in customers] == ["cus_1", "cus_2", "cus_3"]
+    assert customers[0].default_source.id == card.id
+    assert customers[1].default_source.id == bank_account.id
+    assert customers[2].default_source is None
+
+
+@mock.patch("stripe.Customer.retrieve")
+@pytest.mark.django_db
+def test_refresh_serves_local_copy_while_the_circuit_is_open(customer_retrieve, customer,
+                                                             api_client):
+    customer_retrieve.side_effect = CircuitOpenError("Stripe is unavailable.")
+    api_client.force_authenticate(customer.owner)
+
+    uri = reverse("rf_stripe:customer-refresh", kwargs={"pk": customer.pk})
+    response = api_client.get(uri)
+
+    assert response.status_code == 200, response.data
+    assert response["Warning"] == '110 - "Response is Stale"'
+    assert response.data["source"] == customer.source
+
+
+@mock.patch("stripe.Customer.retrieve")
+@pytest.mark.django_db
+def test_refresh_reports_stripe_errors(customer_retrieve, customer, api_client):
+    customer_retrieve.side_effect = stripe.APIConnectionError("timeout")
+    api_client.force_authenticate(customer.owner)
+
+    uri = reverse("rf_stripe:customer-refresh", kwargs={"pk": customer.pk})
+    response = api_client.get(uri)
+
+    assert response.status_code == 400
+    assert "Warning" not in response
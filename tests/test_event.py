@@ -1,5 +1,10 @@
+import io
 from unittest import mock
 
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 import pytest
 import stripe
 from model_mommy import mommy
@@ -8,7 +13,7 @@ from rest_framework.reverse import reverse
 
 from restframework_stripe.test import get_mock_resource
 from restframework_stripe import models
-from restframework_stripe.webhooks import webhooks
+from restframework_stripe.webhooks import handler_name, webhooks
 
 
 @mock.patch("stripe.Event.retrieve")
@@ -57,3 +62,240 @@ def test_process_event_error(event_retrieve, event):
     assert event.verified is True
     assert event.processed is False
     handler.assert_called_with(event, event.source["data"], event_subtype)
+
+
+@pytest.mark.django_db
+def test_receive_event_is_idempotent():
+    payload = dict(get_mock_resource("Event"))
+    first = models.Event.objects.receive(payload)
+    second = models.Event.objects.receive(payload)
+
+    assert first.id == second.id
+    assert first.verified is False
+
+
+@mock.patch.dict("restframework_stripe.STRIPE", {"event_processing": "queue"})
+@mock.patch("stripe.Event.retrieve")
+@pytest.mark.django_db
+def test_webhook_queue_mode(event_retrieve, api_client):
+    uri = reverse("rf_stripe:webhook")
+    response = api_client.post(uri, data=get_mock_resource("Event"), format="json")
+
+    assert response.status_code == 200
+    assert not event_retrieve.called
+    assert models.Event.objects.unprocessed().count() == 1
+
+
+@mock.patch("stripe.Event.retrieve")
+@pytest.mark.django_db
+def test_process_next(event_retrieve, event):
+    event_retrieve.return_value = get_mock_resource("Event")
+
+    claimed = models.Event.objects.process_next()
+
+    assert claimed.id == event.id
+    assert claimed.processed is True
+    assert claimed.attempts == 1
+    assert models.Event.objects.process_next() is None
+
+
+@mock.patch("stripe.Event.retrieve")
+@pytest.mark.django_db
+def test_process_next_handler_failure(event_retrieve, event):
+    event_retrieve.return_value = get_mock_resource("Event")
+    handler = mock.Mock(side_effect=ValueError("boom"))
+    event_type, event_subtype = event.event_type.split(".", 1)
+    webhooks.register(event_type)(handler)
+
+    claimed = models.Event.objects.process_next(max_attempts=1)
+
+    assert claimed.processed is False
+    assert 0 < claimed.processing_errors.count()
+    assert models.Event.objects.process_next(max_attempts=1) is None
+    webhooks.remove_handler(event_type, handler)
+
+
+@mock.patch("stripe.Event.list")
+@pytest.mark.django_db
+def test_verify_bulk(event_list, event):
+    page = stripe.convert_to_stripe_object({
+        "object": "list",
+        "url": "/v1/events",
+        "has_more": False,
+        "data": [get_mock_resource("Event"), get_mock_resource("Event", id="evt_other")],
+        }, None, None)
+    event_list.return_value = page
+
+    verified, missing = models.Event.objects.verify_bulk(created_gte=0)
+
+    event.refresh_from_db()
+    assert event.verified is True
+    assert (verified, missing) == (1, 0)
+    assert event_list.call_count == 1
+
+
+@mock.patch("stripe.Event.list")
+@pytest.mark.django_db
+def test_verify_bulk_replaces_payload(event_list, event):
+    forged = dict(event.source, type="charge.refunded",
+                  data={"object": {"id": "ch_forged", "object": "charge"}})
+    models.Event.objects.filter(pk=event.pk).update(source=forged,
+                                                    event_type="charge.refunded")
+    listed = get_mock_resource("Event")
+    event_list.return_value = stripe.convert_to_stripe_object({
+        "object": "list", "url": "/v1/events", "has_more": False, "data": [listed],
+        }, None, None)
+
+    models.Event.objects.verify_bulk(created_gte=0)
+
+    event.refresh_from_db()
+    assert event.verified is True
+    assert event.event_type == listed["type"]
+    assert event.source["data"] == listed["data"]
+
+
+@mock.patch("stripe.Event.list")
+@pytest.mark.django_db
+def test_verify_bulk_queries(event_list):
+    listed = [get_mock_resource("Event", id="evt_{}".format(i)) for i in range(4)]
+    for stripe_object in listed:
+        models.Event.objects.receive(dict(stripe_object, type="forged.event"))
+    event_list.side_effect = [
+        stripe.convert_to_stripe_object({
+            "object": "list", "url": "/v1/events", "has_more": has_more, "data": data,
+            }, None, None)
+        for data, has_more in ((listed[:2], True), (listed[2:], False))]
+
+    with CaptureQueriesContext(connection) as queries:
+        verified, missing = models.Event.objects.verify_bulk(page_size=2)
+
+    assert (verified, missing) == (4, 0)
+    statements = [q["sql"] for q in queries.captured_queries
+                  if "SAVEPOINT" not in q["sql"]]
+    # a count, then a select and a single update per page
+    assert len(statements) == 5
+    assert sum(1 for sql in statements if sql.startswith("UPDATE")) == 2
+    for event in models.Event.objects.all():
+        assert event.verified is True
+        assert event.event_type == listed[0]["type"]
+
+
+@mock.patch("stripe.Event.list")
+@pytest.mark.django_db
+def test_rf_stripe_verify_events_command(event_list, event):
+    event_list.return_value = stripe.convert_to_stripe_object({
+        "object": "list", "url": "/v1/events", "has_more": False,
+        "data": [get_mock_resource("Event")],
+        }, None, None)
+    out = io.StringIO()
+
+    call_command("rf_stripe_verify_events", since=0, stdout=out)
+
+    event.refresh_from_db()
+    assert event.verified is True
+    assert "Verified 1 events." in out.getvalue()
+    assert event_list.call_args[1]["created"] == {"gte": 0}
+
+
+@mock.patch("stripe.Event.retrieve")
+@pytest.mark.django_db
+def test_process_event_independent_handler_error(event_retrieve, event):
+    event_retrieve.return_value = get_mock_resource("Event")
+    handler = mock.Mock()
+    failing = mock.Mock(side_effect=ValueError("boom"))
+    event_type, event_subtype = event.event_type.split(".", 1)
+    webhooks.register(event_type)(handler)
+    webhooks.register(event_type, independent=True)(failing)
+
+    event.process()
+
+    assert handler.called
+    assert event.processed is False
+    assert 0 < event.processing_errors.count()
+    webhooks.remove_handler(event_type, handler)
+    webhooks.remove_handler(event_type, failing)
+
+
+@mock.patch("stripe.Event.retrieve")
+@pytest.mark.django_db
+def test_process_event_retries_failed_handlers(event_retrieve, event):
+    event_retrieve.return_value = get_mock_resource("Event")
+    ordered = mock.Mock()
+    flaky = mock.Mock(side_effect=[ValueError("boom"), None])
+    succeeding = mock.Mock()
+    event_type, event_subtype = event.event_type.split(".", 1)
+    webhooks.register(event_type)(ordered)
+    webhooks.register(event_type, independent=True)(flaky)
+    webhooks.register(event_type, independent=True)(succeeding)
+
+    event.process()
+    event.refresh_from_db()
+    assert event.processed is False
+    assert event.failed_handlers == [handler_name(flaky)]
+
+    event.process()
+    event.refresh_from_db()
+    assert event.processed is True
+    assert event.failed_handlers == []
+    # only the failed handler ran again
+    assert ordered.call_count == 1
+    assert succeeding.call_count == 1
+    assert flaky.call_count == 2
+
+
+@mock.patch("stripe.Charge.retrieve")
+@mock.patch("stripe.Event.list")
+@pytest.mark.django_db
+def test_sync_from_stripe(event_list, charge_retrieve, charge):
+    def make_event(created, stripe_object):
+        event = {"id": "evt_{}".format(created), "object": "event", "created": created,
+                 "type": "{}.updated".format(stripe_object["object"]),
+                 "data": {"object": stripe_object}}
+        return event
+
+    charge_object = dict(get_mock_resource("Charge"), id=charge.stripe_id)
+    invoice = {"id": "in_1", "object": "invoice", "charge": charge.stripe_id}
+    page = {"object": "list", "url": "/v1/events", "has_more": False, "data": [
+        make_event(300, dict(charge_object, status="refunded")),
+        make_event(200, invoice),
+        make_event(100, dict(charge_object, status="pending")),
+        ]}
+    event_list.return_value = stripe.convert_to_stripe_object(page, None, None)
+
+    result = models.Event.objects.sync_from_stripe(created_gte=50)
+
+    assert event_list.call_args[1]["created"] == {"gte": 50}
+    assert result.events == 3
+    assert result.updated == 1
+    assert result.refreshed == 0
+    assert result.cursor == 300
+    assert not charge_retrieve.called
+    charge.refresh_from_db()
+    assert charge.status == "refunded"
+
+
+@mock.patch("stripe.Event.list")
+@pytest.mark.django_db
+def test_sync_from_stripe_deleted(event_list, coupon, subscription):
+    coupon_object = dict(coupon.source)
+    plan_object = dict(subscription.plan.source, id=subscription.plan.stripe_id)
+    page = {"object": "list", "url": "/v1/events", "has_more": False, "data": [
+        {"id": "evt_2", "object": "event", "created": 200, "type": "coupon.deleted",
+         "data": {"object": coupon_object}},
+        {"id": "evt_1", "object": "event", "created": 100, "type": "coupon.updated",
+         "data": {"object": coupon_object}},
+        {"id": "evt_0", "object": "event", "created": 50, "type": "plan.deleted",
+         "data": {"object": dict(get_mock_resource("Plan"), id="gone_plan")}},
+        {"id": "evt_3", "object": "event", "created": 40, "type": "plan.deleted",
+         "data": {"object": plan_object}},
+        ]}
+    event_list.return_value = stripe.convert_to_stripe_object(page, None, None)
+
+    result = models.Event.objects.sync_from_stripe()
+
+    assert result.deleted == 1
+    assert result.created == 0
+    assert not models.Coupon.objects.filter(pk=coupon.pk).exists()
+    assert not models.Plan.objects.filter(stripe_id="gone_plan").exists()
+    # the subscription still uses the deleted plan
+    assert models.Subscription.objects.filter(pk=subscription.pk).exists()
@@ -1,15 +1,18 @@
 from unittest import mock
 
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
 
 import pytest
+import stripe
 from stripe.error import InvalidRequestError
 
 from restframework_stripe import models
 from restframework_stripe.test import get_mock_resource
 
 
-@mock.patch("requests.post")
+@mock.patch("requests.Session.post")
 @mock.patch("stripe.Account.retrieve")
 @pytest.mark.django_db
 def test_register_standalone_account(retrieve_account_mock, post_mock, user):
@@ -34,7 +37,7 @@ def test_register_standalone_account(retrieve_account_mock, post_mock, user):
     assert connected in models.ConnectedAccount.objects.standalone_accounts()
 
 
-@mock.patch("requests.post")
+@mock.patch("requests.Session.post")
 @pytest.mark.django_db
 def test_register_standalone_account_access_token_failure(post_mock, user):
     data = {
@@ -81,3 +84,75 @@ def test_plan_manager_error(plan_create_mock):
     with pytest.raises(ValidationError) as err:
         plan.save()
     assert err.value.message_dict == {"id": ["no!"]}
+
+
+@pytest.mark.django_db
+def test_upsert_from_stripe(charge, customer):
+    charge.owner = customer.owner
+    charge.save()
+    stripe_objects = [
+        get_mock_resource("Charge", id=charge.stripe_id, status="failed"),
+        get_mock_resource("Charge", id="ch_new", customer=customer.stripe_id),
+        get_mock_resource("Charge", id="ch_orphan", customer="cus_unknown"),
+        ]
+
+    result = models.Charge.objects.upsert_from_stripe(stripe_objects, batch_size=2)
+
+    assert result == (1, 1, 0, 1)
+    charge.refresh_from_db()
+    assert charge.status == "failed"
+    assert charge.owner == customer.owner
+    assert models.Charge.objects.get(stripe_id="ch_new").owner == customer.owner
+    assert not models.Charge.objects.filter(stripe_id="ch_orphan").exists()
+
+
+@mock.patch("stripe.Plan.list")
+@pytest.mark.django_db(transaction=True)
+def test_rf_stripe_sync_command(plan_list):
+    def list_plans(**params):
+        page = {"object": "list", "url": "/v1/plans", "has_more": False,
+                "data": [get_mock_resource("Plan")]}
+        return stripe.convert_to_stripe_object(page, None, None)
+    plan_list.side_effect = list_plans
+
+    call_command("rf_stripe_sync", resources=["Plan"])
+    call_command("rf_stripe_sync", resources=["Plan"])
+
+    plan = models.Plan.objects.get(stripe_id="basic_plan_1")
+    assert plan.interval == models.Plan.MONTHLY
+    assert plan.is_created
+    assert models.SyncCheckpoint.objects.get(resource="Plan").cursor == 1395968059
+    assert "created" not in plan_list.call_args_list[0][1]
+    assert plan_list.call_args_list[1][1]["created"] == {"gte": 1395968059}
+
+
+@pytest.mark.django_db
+def test_source_contains(charge):
+    charge.source["metadata"] = {"order_id": "42"}
+    charge.source["outcome"] = {"type": "authorized", "risk_level": "normal"}
+    charge.save()
+
+    assert list(models.Charge.objects.metadata(order_id=42)) == [charge]
+    assert not models.Charge.objects.metadata(order_id=43).exists()
+    assert models.Charge.objects.source_contains(outcome__type="authorized").exists()
+    assert models.Charge.objects.source_contains(
+        {"metadata": {"order_id": "42"}}, outcome__risk_level="normal").exists()
+    assert not models.Charge.objects.filter(pk=charge.pk).source_contains(
+        outcome__type="blocked").exists()
+
+
+@pytest.mark.django_db
+def test_source_index():
+    manager = models.Charge.objects
+    manager.create_source_index(concurrently=False)
+    manager.create_source_index(concurrently=False)
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = %s",
+                       [manager.source_index_name])
+        assert "jsonb_path_ops" in cursor.fetchone()[0]
+
+        manager.drop_source_index(concurrently=False)
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                       [manager.source_index_name])
+        assert cursor.fetchone() is None
@@ -30,3 +30,15 @@ def test_create_plan(create_plan):
     assert plan.is_created
     assert plan.stripe_id == mocked_plan["id"]
     assert plan.source["interval"] == "month"
+
+
+@pytest.mark.django_db
+def test_upsert_long_plan_name():
+    stripe_object = get_mock_resource("Plan", name="x" * 80)
+    stripe_id = stripe_object["id"]
+
+    result = models.Plan.objects.upsert_from_stripe([stripe_object])
+
+    assert result.created == 1
+    plan = models.Plan.objects.get(stripe_id=stripe_id)
+    assert plan.name_on_invoice == "x" * 50
@@ -0,0 +1,58 @@
+from unittest import mock
+
+import pytest
+import stripe
+
+from restframework_stripe import STRIPE
+from restframework_stripe.models import Plan
+from restframework_stripe.retry import RetryPolicy, is_retryable
+from restframework_stripe.test import get_mock_resource
+
+
+def test_is_retryable():
+    assert is_retryable(stripe.APIConnectionError("timeout"))
+    assert is_retryable(stripe.RateLimitError("slow down", http_status=429))
+    assert is_retryable(stripe.APIError("oops", http_status=503))
+    assert not is_retryable(stripe.CardError("declined", "number", "card_declined"))
+    assert not is_retryable(stripe.InvalidRequestError("missing", "amount"))
+
+
+@mock.patch("time.sleep")
+@mock.patch("stripe.Plan.create")
+def test_create_is_retried_with_the_same_idempotency_key(plan_create, sleep):
+    plan_create.side_effect = [stripe.APIConnectionError("timeout"),
+                               get_mock_resource("Plan")]
+
+    stripe_object = Plan.stripe_api_create(id="basic_plan_1", amount=50)
+
+    assert stripe_object["id"] == "basic_plan_1"
+    assert plan_create.call_count == 2
+    keys = [c[1]["idempotency_key"] for c in plan_create.call_args_list]
+    assert keys[0] and keys[0] == keys[1]
+    assert sleep.call_count == 1
+
+
+@mock.patch("time.sleep")
+@mock.patch("stripe.Plan.create")
+def test_create_is_not_retried_on_client_errors(plan_create, sleep):
+    plan_create.side_effect = stripe.InvalidRequestError("missing", "amount")
+
+    with pytest.raises(stripe.InvalidRequestError):
+        Plan.stripe_api_create(id="basic_plan_1")
+    assert plan_create.call_count == 1
+
+
+@mock.patch("time.sleep")
+@mock.patch("stripe.Plan.create")
+def test_call_site_budget(plan_create, sleep):
+    plan_create.side_effect = stripe.APIError("oops", http_status=500)
+
+    with mock.patch.dict(STRIPE, {"retries": {"Plan.create": {"max_attempts": 5}}}):
+        with pytest.raises(stripe.APIError):
+            Plan.stripe_api_create(id="basic_plan_1")
+    assert plan_create.call_count == 5
+
+
+def test_backoff_is_capped():
+    policy = RetryPolicy(base_delay=1, max_delay=4)
+    assert all(0 <= policy.get_delay(attempt) <= 4 for attempt in range(1, 10))
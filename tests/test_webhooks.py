@@ -1,22 +1,234 @@
+import json
+import time
 from unittest import mock
-from restframework_stripe.webhooks import webhooks
+
+import pytest
+from rest_framework.reverse import reverse
+
+from restframework_stripe import models
+from restframework_stripe.handlers import (DEFAULT_EVENT_TYPES, apply_event_object,
+                                          register_default_handlers)
+from restframework_stripe.test import get_mock_resource
+from restframework_stripe.webhooks import (WebhookRegistry, webhooks, call_independent,
+                                           compute_signature, verify_signature,
+                                           SignatureVerificationError)
 
 
 def test_registering_webhook():
-    @webhooks.register("test")
+    registry = WebhookRegistry()
+
+    @registry.register("test")
     def handler(event, data, event_subtype):
         pass
 
-    assert len(webhooks.REGISTRY["test"]) == 1
+    assert len(registry.REGISTRY["test"]) == 1
 
-    webhooks.remove_handler("test", handler)
-    assert len(webhooks.REGISTRY["test"]) == 0
+    registry.remove_handler("test", handler)
+    assert len(registry.REGISTRY["test"]) == 0
 
 
 def test_registering_calling_webhook():
+    registry = WebhookRegistry()
     m = mock.Mock()
-    webhooks.register("test")(m)
-    webhooks.call_handlers(None, None, "test", None)
+    registry.register("test")(m)
+    registry.call_handlers(None, None, "test", None)
 
     assert m.called
     m.assert_called_with(None, None, None)
+
+
+def test_subtype_routing():
+    registry = WebhookRegistry()
+    exact, prefix, top, wildcard = mock.Mock(), mock.Mock(), mock.Mock(), mock.Mock()
+    registry.register("customer.subscription.updated")(exact)
+    registry.register("customer.subscription.*")(prefix)
+    registry.register("customer")(top)
+    registry.register("*")(wildcard)
+
+    registry.call_handlers(None, None, "customer", "subscription.updated")
+    assert exact.called and prefix.called and top.called and wildcard.called
+
+    for m in (exact, prefix, top, wildcard):
+        m.reset_mock()
+    registry.call_handlers(None, None, "customer", "updated")
+    assert not exact.called and not prefix.called
+    assert top.called and wildcard.called
+
+    registry.remove_handler("customer.subscription.updated", exact)
+    registry.remove_handler("customer.subscription.*", prefix)
+    registry.remove_handler("customer", top)
+    registry.remove_handler("*", wildcard)
+    assert registry.resolve("customer.subscription.updated") == ()
+
+
+def test_default_handlers_registration():
+    registry = WebhookRegistry()
+    register_default_handlers(registry)
+    register_default_handlers(registry)
+    assert registry.resolve("customer.subscription.updated") == (apply_event_object,)
+    assert registry.resolve("invoice.created") == ()
+
+
+def test_default_handler_without_event():
+    assert apply_event_object(None, None, "subscription.updated") is None
+
+
+def test_independent_handlers():
+    ordered = mock.Mock()
+    slow = mock.Mock(side_effect=lambda *args: time.sleep(0.05))
+    failing = mock.Mock(side_effect=ValueError("boom"))
+    webhooks.register("test.concurrent")(ordered)
+    webhooks.register("test.concurrent", independent=True)(slow)
+    webhooks.register("test.concurrent", independent=True)(failing)
+
+    failures = webhooks.call_handlers(None, None, "test", "concurrent")
+
+    assert ordered.called and slow.called and failing.called
+    assert len(failures) == 1
+    assert failures[0][0] is failing
+    assert isinstance(failures[0][1], ValueError)
+
+    for handler in (ordered, slow, failing):
+        webhooks.remove_handler("test.concurrent", handler)
+    assert not webhooks.INDEPENDENT
+
+
+def test_independent_handler_closes_connections():
+    handler = mock.Mock(side_effect=ValueError("boom"))
+    connection = mock.Mock()
+
+    with mock.patch("restframework_stripe.webhooks.connections") as connections:
+        connections.all.return_value = [connection]
+        with pytest.raises(ValueError):
+            call_independent(handler, None, None, "concurrent")
+
+    assert handler.called
+    assert connection.close.called
+
+
+@pytest.fixture
+def default_handlers(request):
+    register_default_handlers()
+
+    def fin():
+        for event_type in DEFAULT_EVENT_TYPES:
+            webhooks.remove_handler(event_type, apply_event_object)
+    request.addfinalizer(fin)
+
+
+def make_charge_event(charge, stripe_id, created, status):
+    stripe_object = dict(get_mock_resource("Charge"), id=charge.stripe_id, status=status)
+    event = models.Event(stripe_id=stripe_id, verified=True, event_type="charge.updated",
+                         source={"created": created, "type": "charge.updated",
+                                 "data": {"object": stripe_object}})
+    event.save()
+    return event
+
+
+def test_default_handlers_are_opt_in():
+    assert apply_event_object not in webhooks.resolve("charge.updated")
+
+
+@pytest.mark.django_db
+def test_default_handler_applies_event_object(default_handlers, charge):
+    with mock.patch("stripe.Charge.retrieve") as charge_retrieve:
+        make_charge_event(charge, "evt_2", 200, "refunded").process()
+        make_charge_event(charge, "evt_1", 100, "pending").process()
+
+    assert not charge_retrieve.called
+    charge.refresh_from_db()
+    assert charge.status == "refunded"
+    assert charge.last_event_created == 200
+    assert charge.source["status"] == "refunded"
+
+
+@pytest.mark.django_db
+def test_default_handler_events_of_the_same_second(default_handlers, charge):
+    current = get_mock_resource("Charge", id=charge.stripe_id, status="refunded")
+
+    with mock.patch("stripe.Charge.retrieve") as charge_retrieve:
+        charge_retrieve.return_value = current
+        make_charge_event(charge, "evt_2", 200, "refunded").process()
+        assert not charge_retrieve.called
+        # the order of the events of a second is unknown, the charge is retrieved
+        make_charge_event(charge, "evt_1", 200, "pending").process()
+        assert charge_retrieve.called
+
+    charge.refresh_from_db()
+    assert charge.status == "refunded"
+    assert charge.last_event_created > 200
+
+
+@pytest.mark.django_db
+def test_default_handler_deleted_events(customer, subscription):
+    def make_event(stripe_object):
+        event_type = "{}.deleted".format(stripe_object["object"])
+        return models.Event(stripe_id="evt_1", verified=True, event_type=event_type,
+                            source={"created": 100, "type": event_type,
+                                    "data": {"object": stripe_object}})
+
+    plan = subscription.plan
+    plan_object = dict(plan.source, id=plan.stripe_id)
+    for instance in (customer, plan, subscription):
+        stripe_object = dict(instance.source, id=instance.stripe_id, deleted=True)
+        if instance is subscription:
+            stripe_object["plan"] = plan_object
+        event = make_event(stripe_object)
+        apply_event_object(event, event.source["data"], "deleted")
+
+    assert not models.Customer.objects.filter(pk=customer.pk).exists()
+    # the plan is kept for the subscription that uses it and is left as it was
+    plan.refresh_from_db()
+    assert "deleted" not in plan.source
+    # a deleted subscription is only canceled
+    subscription.refresh_from_db()
+    assert subscription.source["deleted"] is True
+
+
+def make_header(payload, secret, timestamp=None):
+    timestamp = timestamp or int(time.time())
+    return "t={0},v1={1}".format(timestamp, compute_signature(payload, timestamp, secret))
+
+
+def test_verify_signature():
+    payload = '{"id": "evt_1"}'
+    assert verify_signature(payload, make_header(payload, "whsec_1"), ["whsec_1"])
+
+
+def test_verify_signature_with_rotated_secrets():
+    payload = '{"id": "evt_1"}'
+    header = make_header(payload, "whsec_new")
+    assert verify_signature(payload, header, ["whsec_old", "whsec_new"])
+
+
+def test_verify_signature_mismatch():
+    payload = '{"id": "evt_1"}'
+    with pytest.raises(SignatureVerificationError):
+        verify_signature('{"id": "evt_2"}', make_header(payload, "whsec_1"), ["whsec_1"])
+
+
+def test_verify_signature_tolerance():
+    payload = '{"id": "evt_1"}'
+    header = make_header(payload, "whsec_1", timestamp=int(time.time()) - 600)
+    with pytest.raises(SignatureVerificationError):
+        verify_signature(payload, header, ["whsec_1"], tolerance=300)
+
+
+@mock.patch.dict("restframework_stripe.STRIPE", {
+    "webhook_verification": "signature",
+    "webhook_secrets": ["whsec_1"],
+    "event_processing": "queue",
+    })
+@pytest.mark.django_db
+def test_webhook_signature_verification(api_client):
+    uri = reverse("rf_stripe:webhook")
+    payload = json.dumps(get_mock_resource("Event"))
+
+    response = api_client.post(uri, data=payload, content_type="application/json",
+                               HTTP_STRIPE_SIGNATURE=make_header(payload, "whsec_1"))
+    assert response.status_code == 200
+    assert models.Event.objects.get().verified is True
+
+    response = api_client.post(uri, data=payload, content_type="application/json",
+                               HTTP_STRIPE_SIGNATURE=make_header(payload, "whsec_2"))
+    assert response.status_code == 400